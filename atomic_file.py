@@ -0,0 +1,56 @@
+"""Atomic replacement of files, shared by the store cache, the store editor and the metrics exporter."""
+import os
+import stat
+import tempfile
+from os import path
+
+
+def _read_umask():
+    # os.umask() can only read the umask by setting it, which races with other threads creating
+    # files, so this runs once at import
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return umask
+
+
+_IMPORT_UMASK = _read_umask()
+
+
+def _umask():
+    """The current umask, from /proc where it can be read without changing it."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('Umask:'):
+                    return int(line.split()[1], 8)
+    except OSError:
+        pass
+    return _IMPORT_UMASK
+
+
+def replace_file(target_file, data, mode=None):
+    """Atomically replace target_file with data, readers see either the old or the new contents.
+
+    The new file gets mode masked by the umask if given, otherwise the mode of the file it
+    replaces or, for a new file, the umask default. The temporary file is removed on failure.
+    """
+    fd, tmp = tempfile.mkstemp(dir=path.dirname(path.abspath(target_file)), suffix='.tmp')
+    try:
+        if mode is not None:
+            mode &= ~_umask()
+        else:
+            try:
+                mode = stat.S_IMODE(os.stat(target_file).st_mode)
+            except FileNotFoundError:
+                mode = 0o666 & ~_umask()
+        # mkstemp creates the file as 0600
+        os.fchmod(fd, mode)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, target_file)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+        raise
@@ -0,0 +1,281 @@
+"""Benchmark BCD store generation per backend and mode and compare runs across commits.
+
+For every backend, each mode runs in its own fresh process, so peak RSS is not shared between them:
+direct builds every store through the hive backend, template patches a compiled BCDTemplate and
+cache serves warm StoreCache hits. Reported are per-store latency (p50/p99), stores per second in
+one process and across a worker pool, peak RSS, bytes per store, cold start (import plus opening
+the minimal hive), the time per plan phase and the hive backend calls of a direct build. Inputs come from a seeded RNG,
+so runs are reproducible; save them with --json and check a later run against one with --compare.
+
+With --loaders, measure instead how build time and memory scale with the number of loader
+entries in one store.
+"""
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+import create_bcd
+from metrics_bcd import BuildMetrics
+
+MODES = ('direct', 'template', 'cache')
+
+# 1 if a higher value is better, -1 if a lower one is; other metrics are not compared
+METRIC_DIRECTIONS = {
+    'stores_per_s': 1,
+    'pool_stores_per_s': 1,
+    'p50_ms': -1,
+    'p99_ms': -1,
+    'peak_rss_kib': -1,
+    'bytes_per_store': -1,
+    'cold_start_ms': -1,
+    'hive_calls': -1,
+}
+
+COLD_START = '''
+import time
+start = time.perf_counter()
+import create_bcd
+create_bcd.open_hive({backend!r})
+print(time.perf_counter() - start)
+'''
+
+
+def _inputs(count, seed):
+    rng = random.Random(seed)
+    return [tuple(uuid.UUID(int=rng.getrandbits(128), version=4) for _ in range(3)) for _ in range(count)]
+
+
+def _percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+
+def _run_mode(backend, mode, count, seed):
+    with contextlib.ExitStack() as stack:
+        inputs = _inputs(count, seed)
+        start = time.perf_counter()
+        if mode == 'template':
+            template = create_bcd.default_template(backend)
+            build = template.render
+        elif mode == 'cache':
+            cache = create_bcd.StoreCache(stack.enter_context(tempfile.TemporaryDirectory(prefix='bench_bcd_')))
+            for uuids in inputs:
+                cache.get_or_create(*uuids, backend)
+
+            def build(*uuids):
+                return cache.get_or_create(*uuids, backend)
+        else:
+            def build(*uuids):
+                return create_bcd.BCD(None, *uuids, backend).to_bytes()
+        setup = time.perf_counter() - start
+
+        latencies = []
+        size = 0
+        for uuids in inputs:
+            start = time.perf_counter()
+            size = len(build(*uuids))
+            latencies.append(time.perf_counter() - start)
+        total = sum(latencies)
+        latencies.sort()
+        return {
+            'stores_per_s': count / total,
+            'p50_ms': _percentile(latencies, 50) * 1000,
+            'p99_ms': _percentile(latencies, 99) * 1000,
+            'setup_ms': setup * 1000,
+            # ru_maxrss is in KiB on Linux
+            'peak_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'bytes_per_store': size,
+        }
+
+
+def _run_phases(backend, count, seed):
+    """Mean milliseconds per store of every plan phase, the loader entries and the commit, and hive calls per store."""
+    metrics = BuildMetrics()
+    for uuids in _inputs(count, seed):
+        bcd = create_bcd.BCD(None, *uuids, backend, metrics=metrics)
+        bcd.to_bytes()
+    return {phase: seconds * 1000 / count for phase, seconds in metrics.phase_seconds.items()}, bcd.hive_calls
+
+
+def _cold_start(backend, runs):
+    times = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, '-c', COLD_START.format(backend=backend)], check=True,
+                             capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        times.append(float(out.stdout))
+    times.sort()
+    return _percentile(times, 50) * 1000
+
+
+def _run_pool(backend, mode, count, seed, workers):
+    with tempfile.TemporaryDirectory(prefix='bench_bcd_') as directory:
+        rows = [{'disk_uuid': str(d), 'efi_part_uuid': str(e), 'win_part_uuid': str(w),
+                 'output_path': os.path.join(directory, f'{i}.bcd')}
+                for i, (d, e, w) in enumerate(_inputs(count, seed))]
+        cache_dir = os.path.join(directory, 'cache') if mode == 'cache' else None
+        if cache_dir:
+            for _ in create_bcd.create_batch(rows, workers, backend=backend, cache_dir=cache_dir):
+                pass
+        start = time.perf_counter()
+        for result in create_bcd.create_batch(rows, workers, use_template=mode == 'template', backend=backend,
+                                              cache_dir=cache_dir):
+            if result.error is not None:
+                raise result.error
+        return count / (time.perf_counter() - start)
+
+
+def run_suite(backends, modes, count, seed, workers, cold_runs):
+    ctx = multiprocessing.get_context('spawn')
+    results = {}
+    phases = {}
+    hive_calls = {}
+    cold_start = {}
+    for backend in backends:
+        cold_start[backend] = _cold_start(backend, cold_runs)
+        for mode in modes:
+            with ctx.Pool(1) as pool:
+                result = pool.apply(_run_mode, (backend, mode, count, seed))
+            result['pool_stores_per_s'] = _run_pool(backend, mode, count, seed, workers)
+            results[f'{backend}/{mode}'] = result
+        with ctx.Pool(1) as pool:
+            phases[backend], hive_calls[backend] = pool.apply(_run_phases, (backend, count, seed))
+    return {
+        'meta': {
+            'commit': _git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'count': count,
+            'seed': seed,
+            'workers': workers,
+        },
+        'cold_start_ms': cold_start,
+        'results': results,
+        'phases_ms': phases,
+        'hive_calls': hive_calls,
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _metrics(report):
+    metrics = {}
+    for backend, ms in report.get('cold_start_ms', {}).items():
+        metrics[f'{backend}/cold_start_ms'] = ('cold_start_ms', ms)
+    for backend, calls in report.get('hive_calls', {}).items():
+        metrics[f'{backend}/hive_calls'] = ('hive_calls', calls)
+    for name, result in report.get('results', {}).items():
+        for metric, value in result.items():
+            metrics[f'{name}/{metric}'] = (metric, value)
+    return metrics
+
+
+def compare(report, baseline, threshold):
+    """List (name, baseline value, value, relative change) of the metrics that got worse by more than threshold."""
+    regressions = []
+    old = _metrics(baseline)
+    for name, (metric, value) in _metrics(report).items():
+        direction = METRIC_DIRECTIONS.get(metric)
+        if direction is None or name not in old or not old[name][1]:
+            continue
+        change = (value - old[name][1]) / old[name][1]
+        if -direction * change > threshold:
+            regressions.append((name, old[name][1], value, change))
+    return regressions
+
+
+def print_report(report):
+    print(f'{"backend/mode":<16} {"stores/s":>10} {"pool/s":>10} {"p50 ms":>8} {"p99 ms":>8} {"peak RSS":>12} '
+          f'{"bytes":>8}')
+    for name, r in report['results'].items():
+        print(f'{name:<16} {r["stores_per_s"]:>10.1f} {r["pool_stores_per_s"]:>10.1f} {r["p50_ms"]:>8.3f} '
+              f'{r["p99_ms"]:>8.3f} {r["peak_rss_kib"]:>8} KiB {r["bytes_per_store"]:>8}')
+    for backend, ms in report['cold_start_ms'].items():
+        print(f'{backend} cold start: {ms:.1f} ms')
+    for backend, phases in report['phases_ms'].items():
+        print(f'{backend} phases (ms/store): ' + ', '.join(f'{phase} {ms:.3f}' for phase, ms in phases.items()))
+    for backend, calls in report.get('hive_calls', {}).items():
+        print(f'{backend} hive calls/store: {calls}')
+
+
+def _build_with_loaders(backend, loaders):
+    bcd = create_bcd.BCD(None, uuid.uuid4(), uuid.uuid4(), uuid.uuid4(), backend)
+    for _ in range(loaders):
+        bcd.add_loader(uuid.uuid4())
+    return bcd.to_bytes()
+
+
+def _run_loaders(backend, loaders):
+    start = time.perf_counter()
+    size = len(_build_with_loaders(backend, loaders))
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    _build_with_loaders(backend, loaders)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak, size
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=200, help='stores to build per backend and mode')
+    parser.add_argument('--backend', action='append', choices=create_bcd.BACKENDS,
+                        help='backend to benchmark, may be repeated (default: all available)')
+    parser.add_argument('--mode', action='append', choices=MODES,
+                        help='mode to benchmark, may be repeated (default: all)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='worker processes for pool runs')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the generated disk layouts')
+    parser.add_argument('--cold-runs', type=int, default=5, help='interpreter starts to take the cold start median of')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', metavar='BASELINE', help='results of an earlier --json run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative change of a metric that counts as a regression (default: 0.1)')
+    parser.add_argument('--loaders', type=int, nargs='*', metavar='N',
+                        help='loader entries per store to measure scaling for (default: 10 100 1000)')
+    args = parser.parse_args(argv)
+
+    backends = args.backend or [b for b in create_bcd.BACKENDS if b != 'hivex' or create_bcd.hivex is not None]
+    if args.loaders is not None:
+        ctx = multiprocessing.get_context('spawn')
+        print(f'{"backend":<8} {"loaders":>8} {"build ms":>10} {"ms/loader":>10} {"peak alloc":>12} {"size":>10}')
+        for backend in backends:
+            for loaders in args.loaders or [10, 100, 1000]:
+                with ctx.Pool(1) as pool:
+                    elapsed, peak, size = pool.apply(_run_loaders, (backend, loaders))
+                print(f'{backend:<8} {loaders:>8} {elapsed * 1000:>10.1f} {elapsed * 1000 / loaders:>10.3f} '
+                      f'{peak // 1024:>8} KiB {size:>10}')
+        return 0
+
+    report = run_suite(backends, args.mode or MODES, args.count, args.seed, args.workers, args.cold_runs)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        for name, old, new, change in regressions:
+            print(f'REGRESSION {name}: {old:.3f} -> {new:.3f} ({change:+.1%})')
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,295 @@
+"""Pack many nearly identical BCD stores into one bundle file and extract any of them by key.
+
+A bundle holds one base image and, per store, the runs of bytes where that store differs from
+the base, which for stores of one schema are just the GUIDs, device elements and checksum. An
+open addressing hash table at the end of the file finds a store's record in O(1). Extraction
+reads the base and the runs straight out of a memory-mapped bundle without intermediate copies.
+
+Layout, all integers little endian:
+    header      HEADER
+    base image  base_length bytes
+    records     RECORD, key, run_count RUN entries, then the bytes of all runs
+    index       slots SLOT entries, a record offset of 0 marks an empty slot
+"""
+import argparse
+import hashlib
+import mmap
+import os
+import re
+import struct
+import sys
+from os import path
+
+MAGIC = b'BCDBNDL1'
+VERSION = 1
+
+# magic, version, number of stores, index slots, base length, base offset, index offset
+HEADER = struct.Struct('<8sIIIIQQ')
+# key length, store length, run count
+RECORD = struct.Struct('<HII')
+# offset, length
+RUN = struct.Struct('<II')
+# key hash, record offset
+SLOT = struct.Struct('<QQ')
+
+# differing bytes closer than a RUN entry are cheaper to store as one run
+_DIFF_RUNS = re.compile(rb'[^\x00](?:\x00{0,%d}[^\x00])*' % RUN.size, re.DOTALL)
+
+
+def key_hash(key):
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+
+
+def diff_runs(base, image):
+    """(offset, length) runs where image differs from base, plus any part of image beyond base."""
+    size = min(len(base), len(image))
+    xor = (int.from_bytes(base[:size], 'little') ^ int.from_bytes(image[:size], 'little')).to_bytes(size, 'little')
+    runs = [(m.start(), m.end() - m.start()) for m in _DIFF_RUNS.finditer(xor)]
+    if len(image) > size:
+        runs.append((size, len(image) - size))
+    return runs
+
+
+class BundleWriter:
+    """Write a bundle, taking the first store added as the base unless one is given."""
+
+    def __init__(self, bundle_file, base=None):
+        self.bundle_file = bundle_file
+        self.base = None
+        self._f = open(bundle_file, 'wb')
+        # (key hash, record offset) per store
+        self._records = []
+        self._keys = set()
+        if base is not None:
+            self._set_base(base)
+
+    def _set_base(self, base):
+        self.base = bytes(base)
+        self._f.write(bytes(HEADER.size))
+        self._f.write(self.base)
+
+    def add(self, key, image):
+        """Add a store under key (str or bytes), return the bytes of its record."""
+        if isinstance(key, str):
+            key = key.encode()
+        if key in self._keys:
+            raise ValueError(f'duplicate key {key!r}')
+        if self.base is None:
+            self._set_base(image)
+        runs = diff_runs(self.base, image)
+        record = bytearray(RECORD.pack(len(key), len(image), len(runs)))
+        record += key
+        for offset, length in runs:
+            record += RUN.pack(offset, length)
+        for offset, length in runs:
+            record += image[offset:offset + length]
+        self._records.append((key_hash(key), self._f.tell()))
+        self._keys.add(key)
+        self._f.write(record)
+        return len(record)
+
+    def close(self):
+        if self._f.closed:
+            return
+        if self.base is None:
+            self._set_base(b'')
+        # at most half full, so probe sequences stay short
+        slots = max(1, 2 * len(self._records))
+        index = bytearray(slots * SLOT.size)
+        for h, offset in self._records:
+            i = h % slots
+            while SLOT.unpack_from(index, i * SLOT.size)[1]:
+                i = (i + 1) % slots
+            SLOT.pack_into(index, i * SLOT.size, h, offset)
+        index_offset = self._f.tell()
+        self._f.write(index)
+        self._f.seek(0)
+        self._f.write(HEADER.pack(MAGIC, VERSION, len(self._records), slots, len(self.base), HEADER.size,
+                                  index_offset))
+        self._f.close()
+
+    def abort(self):
+        """Close and remove an unfinished bundle."""
+        if self._f.closed:
+            return
+        self._f.close()
+        os.remove(self.bundle_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class BundleReader:
+    """Memory-mapped bundle, look up stores by key with get() or extract()."""
+
+    def __init__(self, bundle_file):
+        with open(bundle_file, 'rb') as f:
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.buf)
+        if len(self.buf) < HEADER.size:
+            self.close()
+            raise ValueError(f'{bundle_file} is not a BCD bundle')
+        magic, version, self.stores, self.slots, base_length, base_offset, self.index_offset = \
+            HEADER.unpack_from(self.buf)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(f'{bundle_file} is not a version {VERSION} BCD bundle')
+        self.base = self.view[base_offset:base_offset + base_length]
+
+    def close(self):
+        if hasattr(self, 'base'):
+            self.base.release()
+        self.view.release()
+        self.buf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.stores
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def _find(self, key):
+        if isinstance(key, str):
+            key = key.encode()
+        h = key_hash(key)
+        i = h % self.slots
+        while True:
+            slot_hash, offset = SLOT.unpack_from(self.buf, self.index_offset + i * SLOT.size)
+            if not offset:
+                return None
+            if slot_hash == h:
+                key_length = RECORD.unpack_from(self.buf, offset)[0]
+                start = offset + RECORD.size
+                if self.view[start:start + key_length] == key:
+                    return offset
+            i = (i + 1) % self.slots
+
+    def _record(self, key):
+        offset = self._find(key)
+        if offset is None:
+            raise KeyError(key)
+        key_length, size, run_count = RECORD.unpack_from(self.buf, offset)
+        runs_offset = offset + RECORD.size + key_length
+        data = runs_offset + run_count * RUN.size
+        runs = []
+        for run_offset, length in RUN.iter_unpack(self.view[runs_offset:data]):
+            runs.append((run_offset, length, data))
+            data += length
+        return size, runs
+
+    def keys(self):
+        for i in range(self.slots):
+            offset = SLOT.unpack_from(self.buf, self.index_offset + i * SLOT.size)[1]
+            if offset:
+                key_length = RECORD.unpack_from(self.buf, offset)[0]
+                yield bytes(self.buf[offset + RECORD.size:offset + RECORD.size + key_length]).decode()
+
+    def extract(self, key, out):
+        """Write the store of key into a binary file object or a writable buffer, return its size.
+
+        File objects are written straight from the mapped base and runs, buffers filled in place.
+        """
+        size, runs = self._record(key)
+        view = self.view
+        if hasattr(out, 'write'):
+            pos = 0
+            for offset, length, data in runs:
+                if offset > pos:
+                    out.write(self.base[pos:offset])
+                out.write(view[data:data + length])
+                pos = offset + length
+            if pos < size:
+                out.write(self.base[pos:size])
+            return size
+        target = memoryview(out).cast('B')
+        if len(target) < size:
+            raise ValueError(f'buffer of {len(target)} bytes is too small for a {size} byte store')
+        base_size = min(size, len(self.base))
+        target[:base_size] = self.base[:base_size]
+        for offset, length, data in runs:
+            target[offset:offset + length] = view[data:data + length]
+        return size
+
+    def get(self, key):
+        size, _ = self._record(key)
+        buf = bytearray(size)
+        self.extract(key, buf)
+        return bytes(buf)
+
+
+def key_file_name(key):
+    """<key>.bcd, ValueError if key could name a file outside the directory it is extracted to."""
+    if not key or '..' in key or any(c in key for c in ('/', '\\', '\x00', os.sep, os.altsep) if c):
+        raise ValueError(f'unsafe key {key!r}')
+    return key + '.bcd'
+
+
+def pack(bundle_file, store_files, base=None):
+    """Bundle store files keyed by their file name without extension, return the bundle size."""
+    with BundleWriter(bundle_file, base) as writer:
+        for store_file in store_files:
+            with open(store_file, 'rb') as f:
+                writer.add(path.splitext(path.basename(store_file))[0], f.read())
+    return path.getsize(bundle_file)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Pack BCD stores into a bundle or extract them from one.')
+    sub = parser.add_subparsers(dest='command', required=True)
+    pack_parser = sub.add_parser('pack', help='bundle store files, keyed by file name without extension')
+    pack_parser.add_argument('bundle')
+    pack_parser.add_argument('paths', nargs='+', help='BCD store files or directories of *.bcd files')
+    extract_parser = sub.add_parser('extract', help='write the stores of keys to a directory')
+    extract_parser.add_argument('bundle')
+    extract_parser.add_argument('keys', nargs='*', help='keys to extract (default: all)')
+    extract_parser.add_argument('-o', '--output-dir', default='.', help='directory to write <key>.bcd files to')
+    list_parser = sub.add_parser('list', help='print the keys of a bundle')
+    list_parser.add_argument('bundle')
+    args = parser.parse_args(argv)
+
+    if args.command == 'pack':
+        store_files = []
+        for p in args.paths:
+            store_files.extend(sorted(e.path for e in os.scandir(p) if e.is_file() and e.name.endswith('.bcd'))
+                               if os.path.isdir(p) else [p])
+        total = sum(path.getsize(f) for f in store_files)
+        size = pack(args.bundle, store_files)
+        print(f'{len(store_files)} stores, {total} bytes -> {size} bytes ({size / max(total, 1):.1%})')
+        return 0
+
+    with BundleReader(args.bundle) as reader:
+        if args.command == 'list':
+            for key in reader.keys():
+                print(key)
+            return 0
+        failed = 0
+        for key in args.keys or list(reader.keys()):
+            if key not in reader:
+                failed += 1
+                print(f'{key}: not in bundle', file=sys.stderr)
+                continue
+            try:
+                file_name = key_file_name(key)
+            except ValueError as e:
+                failed += 1
+                print(f'{key}: {e}', file=sys.stderr)
+                continue
+            with open(path.join(args.output_dir, file_name), 'wb') as f:
+                reader.extract(key, f)
+        return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,13 +1,79 @@
-import shutil
+import argparse
+import csv
+import hashlib
+import json
+import os
 import struct
+import sys
+import tempfile
+import time
 import uuid
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from functools import lru_cache
 from os import path
 
-import hivex
-from hivex.hive_types import *
+try:
+    import hivex
+except ImportError:  # the built-in regf backend works without libhivex
+    hivex = None
+
+import regf
+from atomic_file import replace_file
+from metrics_bcd import BuildMetrics
+from regf import REG_BINARY, REG_DWORD, REG_MULTI_SZ, REG_SZ
 
 LOCALE = r'en-US'
 
+# Empty hive every store starts from
+MINIMAL_HIVE = path.join(path.dirname(__file__), 'minimal')
+# hivex can only serialize into a file, in-memory output goes through a scratch file on tmpfs
+SCRATCH_DIR = '/dev/shm' if path.isdir('/dev/shm') else None
+
+BACKENDS = ('hivex', 'regf')
+DEFAULT_BACKEND = 'hivex' if hivex is not None else 'regf'
+
+
+@lru_cache(maxsize=None)
+def minimal_image():
+    """Contents of the minimal hive, read once per process."""
+    with open(MINIMAL_HIVE, 'rb') as f:
+        return f.read()
+
+
+def open_hive(backend, deterministic=False):
+    """Open a writable copy of the minimal hive with the given backend.
+
+    With deterministic, the regf backend stamps keys with the minimal hive's timestamp instead of
+    the current time. hivex always uses the current time.
+    """
+    if backend == 'hivex':
+        if hivex is None:
+            raise ImportError('the hivex backend needs the hivex Python bindings')
+        return hivex.Hivex(MINIMAL_HIVE, write=True)
+    if backend == 'regf':
+        image = minimal_image()
+        return regf.Hive(image, regf.header_timestamp(image) if deterministic else None)
+    raise ValueError(f'unknown backend {backend!r}, expected one of {", ".join(BACKENDS)}')
+
+
+# Bump when DEFAULT_SCHEMA changes the generated stores, it is part of every StoreCache key
+SCHEMA_VERSION = 2
+
+# Namespace of the GUIDs derived from the disk layout of deterministic stores
+BCD_NAMESPACE = uuid.UUID('0e0f2b0c-3f52-4c5e-9d0b-6a1d58c1e2a7')
+
+
+def derive_uuid(kind, *parts):
+    return uuid.uuid5(BCD_NAMESPACE, '/'.join([kind, *map(str, parts)]))
+
+
+def deterministic_uuids(disk_uuid, efi_part_uuid, win_part_uuid):
+    """Loader and resume GUIDs that only depend on the disk layout."""
+    return (derive_uuid('loader', disk_uuid, efi_part_uuid, win_part_uuid),
+            derive_uuid('resume', disk_uuid, efi_part_uuid, win_part_uuid))
+
+
 CONST_DESC = 'Description'
 CONST_ELEMENTS = 'Elements'
 CONST_ELEMENT = 'Element'
@@ -45,6 +111,18 @@ ELEMENT_FORMAT_GUID_LIST = 0x0400_0000
 ELEMENT_FORMAT_INTEGER = 0x0500_0000
 ELEMENT_FORMAT_BOOLEAN = 0x0600_0000
 ELEMENT_FORMAT_INTEGER_LIST = 0x0700_0000
+ELEMENT_FORMAT_MASK = 0x0f00_0000
+
+# element format -> label of its value bytes in BuildMetrics
+ELEMENT_FORMAT_NAMES = {
+    ELEMENT_FORMAT_DEVICE: 'device',
+    ELEMENT_FORMAT_STRING: 'string',
+    ELEMENT_FORMAT_GUID: 'guid',
+    ELEMENT_FORMAT_GUID_LIST: 'guid_list',
+    ELEMENT_FORMAT_INTEGER: 'integer',
+    ELEMENT_FORMAT_BOOLEAN: 'boolean',
+    ELEMENT_FORMAT_INTEGER_LIST: 'integer_list',
+}
 
 
 def create_element_type(element_class, element_format, element_id, test=None):
@@ -170,220 +248,899 @@ def create_device_value(disk_uuid, part_uuid):
     return bytes(result)
 
 
-class BCD:
-    def __init__(self, target_file, disk_uuid, efi_part_uuid, win_part_uuid):
-        self.target_file = target_file
-        self.disk_uuid = disk_uuid
-        self.efi_part_uuid = efi_part_uuid
-        self.win_part_uuid = win_part_uuid
+DeviceValue = namedtuple('DeviceValue', 'device_type part_uuid disk_uuid data')
 
-        self.hive = hivex.Hivex(path.join(path.dirname(__file__), 'minimal'), write=True)
-        self.root = self.hive.root()
-        self.objects = None
 
-        self.loader_uuid = uuid.uuid4()
-        self.resume_uuid = uuid.uuid4()
+def parse_device_value(data):
+    """Split a device element into its type and, for qualified partitions, partition and disk UUIDs."""
+    device_type = data[0x10] if len(data) > 0x10 else None
+    if device_type == 0x06 and len(data) >= 0x48:
+        return DeviceValue(device_type, uuid.UUID(bytes_le=bytes(data[0x20:0x30])),
+                           uuid.UUID(bytes_le=bytes(data[0x38:0x48])), bytes(data))
+    return DeviceValue(device_type, None, None, bytes(data))
 
-    def create(self):
-        self._create_description()
-        self._create_objects()
-        self._create_ems()
-        self._create_resume_loader_settings()
-        self._create_debugger_settings()
-        self._create_bad_memory()
-        self._create_boot_loader_settings()
-        self._create_global_settings()
-        self._create_hypervisor_settings()
-        self._create_windows_bootmgr()
-        self._create_firmware_bootmgr()
-        self._create_windows_memory_tester()
-        self._create_windows_resume()
-        self._create_windows_loader()
-        self.hive.commit(self.target_file)
-
-    def _set_value(self, node, key, t, value):
-        self.hive.node_set_value(node, {
-            'key': key,
-            't': t,
-            'value': value
-        })
-
-    def _set_sz(self, node, key, string):
-        self._set_value(node, key, REG_SZ, string.encode('utf-16-le') + b'\x00\x00')
-
-    def _set_dword(self, node, key, dword):
-        self._set_value(node, key, REG_DWORD, struct.pack('<I', dword))
-
-    def _set_binary(self, node, key, binary):
-        self._set_value(node, key, REG_BINARY, binary)
-
-    def _set_multi_sz(self, node, key, strings):
-        self._set_value(node, key, REG_MULTI_SZ,
-                        b''.join(x.encode('utf-16-le') + b'\x00\x00' for x in strings) + b'\x00\x00')
-
-    def _create_description(self):
-        node = self.hive.node_add_child(self.root, CONST_DESC)
-        self._set_sz(node, 'KeyName', 'BCD00000000')
-        self._set_dword(node, 'System', 0x1)
-        self._set_dword(node, 'TreatAsSystem', 0x1)
-
-    def _create_objects(self):
-        self.objects = self.hive.node_add_child(self.root, 'Objects')
-
-    def _create_object(self, guid, type_dword, firmware_variable=None):
-        node = self.hive.node_add_child(self.objects, guid)
-        desc = self.hive.node_add_child(node, CONST_DESC)
-        self._set_dword(desc, 'Type', type_dword)
-        if firmware_variable:
-            self._set_binary(desc, 'FirmwareVariable', firmware_variable)
-        self.hive.node_add_child(node, CONST_ELEMENTS)
-        return node
-
-    def _create_element(self, obj_node, key, setter, value):
-        elements = self.hive.node_get_child(obj_node, CONST_ELEMENTS)
-        element = self.hive.node_add_child(elements, key)
-        setter(element, CONST_ELEMENT, value)
-
-    def _create_ems(self):
-        obj_node = self._create_object(GUID_EMS_SETTINGS_GROUP, OBJECT_TYPE_EMS_SETTINGS)
-        self._create_element(obj_node, BCDE_LIBRARY_TYPE_EMS_ENABLED, self._set_binary, b'\x00')
-
-    def _create_resume_loader_settings(self):
-        obj_node = self._create_object(GUID_RESUME_LOADER_SETTINGS_GROUP, OBJECT_TYPE_RESUME_LOADER_SETTINGS)
-        self._create_element(obj_node, BCDE_LIBRARY_TYPE_INHERIT, self._set_multi_sz, [GUID_GLOBAL_SETTINGS_GROUP])
-
-    def _create_debugger_settings(self):
-        obj_node = self._create_object(GUID_DEBUGGER_SETTINGS_GROUP, OBJECT_TYPE_DEBUGGER_SETTINGS)
-        # 4 means Local debugger type
-        self._create_element(obj_node, BCDE_LIBRARY_TYPE_DEBUGGER_TYPE, self._set_binary,
-                             pack_uint64(0x4))
 
-    def _create_bad_memory(self):
-        # no elements
-        self._create_object(GUID_BAD_MEMORY_GROUP, OBJECT_TYPE_BAD_MEMORY)
+# Per-store parameters a schema refers to, filled in by BCD._slots()
+Slot = namedtuple('Slot', 'name')
+EFI_DEVICE_SLOT = Slot('efi_device')
+DEFAULT_LOADER_SLOT = Slot('default_loader')
+DEFAULT_RESUME_SLOT = Slot('default_resume')
+DISPLAY_ORDER_SLOT = Slot('display_order')
+# Per-loader parameters of the loader objects, filled in by BCD._loader_slots()
+LOADER_SLOT = Slot('loader')
+RESUME_SLOT = Slot('resume')
+OS_DEVICE_SLOT = Slot('os_device')
+DESCRIPTION_SLOT = Slot('description')
+SYSTEM_ROOT_SLOT = Slot('system_root')
+
+# Registry value type and data of an element; data is a tuple of bytes and Slot parts
+ElementValue = namedtuple('ElementValue', 'value_type parts')
+
+
+def _sz_parts(string):
+    # a string is a str, a Slot or a tuple of both that is concatenated
+    pieces = string if type(string) is tuple else (string,)
+    return tuple(p if type(p) is Slot else p.encode('utf-16-le') for p in pieces) + (b'\x00\x00',)
+
+
+def string_element(string):
+    return ElementValue(REG_SZ, _sz_parts(string))
+
+
+def guid_element(guid):
+    return ElementValue(REG_SZ, _sz_parts(guid))
+
 
-    def _create_boot_loader_settings(self):
-        obj_node = self._create_object(GUID_BOOT_LOADER_SETTINGS_GROUP, OBJECT_TYPE_BOOT_LOADER_SETTINGS)
-        self._create_element(obj_node, BCDE_LIBRARY_TYPE_INHERIT, self._set_multi_sz, [
+def guid_list_element(guids):
+    return ElementValue(REG_MULTI_SZ, tuple(p for guid in guids for p in _sz_parts(guid)) + (b'\x00\x00',))
+
+
+def integer_element(i):
+    return ElementValue(REG_BINARY, (pack_uint64(i),))
+
+
+def integer_list_element(ints):
+    return ElementValue(REG_BINARY, tuple(pack_uint64(i) for i in ints))
+
+
+def boolean_element(b):
+    return ElementValue(REG_BINARY, (b'\x01' if b else b'\x00',))
+
+
+def device_element(device):
+    return ElementValue(REG_BINARY, (device,))
+
+
+def _join_parts(parts):
+    """Merge adjacent constant parts, plain bytes if nothing is left to fill in per store."""
+    merged = []
+    for part in parts:
+        if merged and type(part) is bytes and type(merged[-1]) is bytes:
+            merged[-1] += part
+        else:
+            merged.append(part)
+    if len(merged) == 1 and type(merged[0]) is bytes:
+        return merged[0]
+    return tuple(merged)
+
+
+class BCDObject:
+    def __init__(self, name, guid, type_dword, elements=()):
+        self.name = name
+        self.guid = guid
+        self.type_dword = type_dword
+        self.elements = dict(elements)
+
+
+class Schema:
+    """The objects of a BCD store as data, compiled once into a flat write plan.
+
+    objects are written once per store, loader_objects once per loader entry of the store (see
+    BCD.add_loader()) with their own slots.
+
+    The plan is a list of (phase, entries) with one phase for the root Description, one for
+    Objects and one per object. Entries are (path, dynamic, values, fill) tuples, one per key in
+    creation order: path is the key path below the root, dynamic marks paths that contain a Slot,
+    values are the hivex value dicts of the key and fill marks values with Slot parts. Values are
+    encoded at compile time, except for the Slot parts that differ per store.
+    """
+
+    def __init__(self, objects, loader_objects=()):
+        self.objects = list(objects)
+        self.loader_objects = list(loader_objects)
+        self._plan = None
+        self._loader_plans = {}
+        self._fingerprint = None
+
+    def copy(self):
+        return Schema((BCDObject(o.name, o.guid, o.type_dword, o.elements) for o in self.objects),
+                      (BCDObject(o.name, o.guid, o.type_dword, o.elements) for o in self.loader_objects))
+
+    def get_object(self, name_or_guid):
+        for obj in self.objects + self.loader_objects:
+            if name_or_guid in (obj.name, obj.guid):
+                return obj
+        raise KeyError(name_or_guid)
+
+    def add_object(self, name, guid, type_dword, elements=()):
+        self.objects.append(BCDObject(name, guid, type_dword, elements))
+        self._invalidate()
+
+    def set_element(self, name_or_guid, element_type, value):
+        self.get_object(name_or_guid).elements[element_type] = value
+        self._invalidate()
+
+    def remove_element(self, name_or_guid, element_type):
+        del self.get_object(name_or_guid).elements[element_type]
+        self._invalidate()
+
+    def set_timeout(self, seconds):
+        self.set_element(GUID_WINDOWS_BOOTMGR, BCDE_BOOTMGR_TYPE_TIMEOUT, integer_element(seconds))
+
+    def set_locale(self, locale):
+        for obj in self.objects + self.loader_objects:
+            if BCDE_LIBRARY_TYPE_PREFERRED_LOCALE in obj.elements:
+                obj.elements[BCDE_LIBRARY_TYPE_PREFERRED_LOCALE] = string_element(locale)
+        self._invalidate()
+
+    def set_description(self, name_or_guid, description):
+        self.set_element(name_or_guid, BCDE_LIBRARY_TYPE_DESCRIPTION, string_element(description))
+
+    def _invalidate(self):
+        self._plan = None
+        self._loader_plans.clear()
+        self._fingerprint = None
+
+    def plan(self):
+        if self._plan is None:
+            self._plan = self._compile()
+        return self._plan
+
+    def fingerprint(self):
+        """Hash of everything the schema writes, changes whenever a customization changes the output."""
+        if self._fingerprint is None:
+            plans = self.plan(), self.loader_plan(True), self.loader_plan(False)
+            self._fingerprint = hashlib.sha256(repr(plans).encode()).hexdigest()
+        return self._fingerprint
+
+    def loader_plan(self, resume=True):
+        """Plan of the loader objects; without resume everything referring to RESUME_SLOT is left out."""
+        plan = self._loader_plans.get(resume)
+        if plan is None:
+            plan = self._loader_plans[resume] = [
+                _object_phase(obj, None if resume else RESUME_SLOT)
+                for obj in self.loader_objects if resume or obj.guid != RESUME_SLOT
+            ]
+        return plan
+
+    def _compile(self):
+        plan = [
+            ('description', [_plan_entry((CONST_DESC,), [
+                ('KeyName', REG_SZ, 'BCD00000000'.encode('utf-16-le') + b'\x00\x00'),
+                ('System', REG_DWORD, struct.pack('<I', 0x1)),
+                ('TreatAsSystem', REG_DWORD, struct.pack('<I', 0x1)),
+            ])]),
+            ('objects', [_plan_entry(('Objects',))]),
+        ]
+        plan.extend(_object_phase(obj) for obj in self.objects)
+        return plan
+
+
+def _object_phase(obj, skip_slot=None):
+    obj_path = ('Objects', obj.guid)
+    entries = [
+        _plan_entry(obj_path),
+        _plan_entry(obj_path + (CONST_DESC,), [('Type', REG_DWORD, struct.pack('<I', obj.type_dword))]),
+        _plan_entry(obj_path + (CONST_ELEMENTS,)),
+    ]
+    for element_type, value in obj.elements.items():
+        if skip_slot in value.parts:
+            continue
+        entries.append(_plan_entry(obj_path + (CONST_ELEMENTS, element_type),
+                                   [(CONST_ELEMENT, value.value_type, _join_parts(value.parts))]))
+    return obj.name, entries
+
+
+def _plan_entry(node_path, values=()):
+    values = [{'key': key, 't': t, 'value': data} for key, t, data in values]
+    return (node_path, any(type(p) is Slot for p in node_path), values,
+            any(type(v['value']) is not bytes for v in values))
+
+
+DEFAULT_SCHEMA = Schema([
+    BCDObject('ems', GUID_EMS_SETTINGS_GROUP, OBJECT_TYPE_EMS_SETTINGS, [
+        (BCDE_LIBRARY_TYPE_EMS_ENABLED, boolean_element(False)),
+    ]),
+    BCDObject('resume_loader_settings', GUID_RESUME_LOADER_SETTINGS_GROUP, OBJECT_TYPE_RESUME_LOADER_SETTINGS, [
+        (BCDE_LIBRARY_TYPE_INHERIT, guid_list_element([GUID_GLOBAL_SETTINGS_GROUP])),
+    ]),
+    BCDObject('debugger_settings', GUID_DEBUGGER_SETTINGS_GROUP, OBJECT_TYPE_DEBUGGER_SETTINGS, [
+        # 4 means Local debugger type
+        (BCDE_LIBRARY_TYPE_DEBUGGER_TYPE, integer_element(0x4)),
+    ]),
+    # no elements
+    BCDObject('bad_memory', GUID_BAD_MEMORY_GROUP, OBJECT_TYPE_BAD_MEMORY),
+    BCDObject('boot_loader_settings', GUID_BOOT_LOADER_SETTINGS_GROUP, OBJECT_TYPE_BOOT_LOADER_SETTINGS, [
+        (BCDE_LIBRARY_TYPE_INHERIT, guid_list_element([
             GUID_GLOBAL_SETTINGS_GROUP,
             GUID_HYPERVISOR_SETTINGS_GROUP
-        ])
-
-    def _create_global_settings(self):
-        obj_node = self._create_object(GUID_GLOBAL_SETTINGS_GROUP, OBJECT_TYPE_GLOBAL_SETTINGS)
-        self._create_element(obj_node, BCDE_LIBRARY_TYPE_INHERIT, self._set_multi_sz, [
+        ])),
+    ]),
+    BCDObject('global_settings', GUID_GLOBAL_SETTINGS_GROUP, OBJECT_TYPE_GLOBAL_SETTINGS, [
+        (BCDE_LIBRARY_TYPE_INHERIT, guid_list_element([
             GUID_DEBUGGER_SETTINGS_GROUP,
             GUID_EMS_SETTINGS_GROUP,
             GUID_BAD_MEMORY_GROUP
-        ])
-
-    def _create_hypervisor_settings(self):
-        obj_node = self._create_object(GUID_HYPERVISOR_SETTINGS_GROUP, OBJECT_TYPE_HYPERVISOR_SETTINGS)
+        ])),
+    ]),
+    BCDObject('hypervisor_settings', GUID_HYPERVISOR_SETTINGS_GROUP, OBJECT_TYPE_HYPERVISOR_SETTINGS, [
         # 0 means Serial debugger
-        self._create_element(obj_node, BCDE_OSLOADER_TYPE_HYPERVISOR_DEBUGGER_TYPE, self._set_binary, pack_uint64(0x0))
-        self._create_element(obj_node, BCDE_OSLOADER_TYPE_HYPERVISOR_DEBUGGER_PORT_NUMBER, self._set_binary,
-                             pack_uint64(0x1))
-        self._create_element(obj_node, BCDE_OSLOADER_TYPE_HYPERVISOR_DEBUGGER_BAUDRATE, self._set_binary,
-                             pack_uint64(115200))
-
-    def _create_windows_bootmgr(self):
-        obj_node = self._create_object(GUID_WINDOWS_BOOTMGR, OBJECT_TYPE_WINDOWS_BOOTMGR)
-        self._create_element(obj_node, BCDE_LIBRARY_TYPE_APPLICATION_DEVICE, self._set_binary,
-                             create_device_value(self.disk_uuid, self.efi_part_uuid))
-        self._create_element(obj_node, BCDE_LIBRARY_TYPE_APPLICATION_PATH, self._set_sz,
-                             r'\EFI\Microsoft\Boot\bootmgfw.efi')
-        self._create_element(obj_node, BCDE_LIBRARY_TYPE_DESCRIPTION, self._set_sz, r'Windows Boot Manager')
-        self._create_element(obj_node, BCDE_LIBRARY_TYPE_PREFERRED_LOCALE, self._set_sz, LOCALE)
-        self._create_element(obj_node, BCDE_LIBRARY_TYPE_INHERIT, self._set_multi_sz, [
-            GUID_GLOBAL_SETTINGS_GROUP
-        ])
-        self._create_element(obj_node, BCDE_BOOTMGR_TYPE_DEFAULT_OBJECT, self._set_sz, format_uuid(self.loader_uuid))
-        self._create_element(obj_node, BCDE_BOOTMGR_TYPE_RESUME_OBJECT, self._set_sz, format_uuid(self.resume_uuid))
-        self._create_element(obj_node, BCDE_BOOTMGR_TYPE_DISPLAY_ORDER, self._set_multi_sz, [
-            format_uuid(self.loader_uuid)
-        ])
-        self._create_element(obj_node, BCDE_BOOTMGR_TYPE_TOOLS_DISPLAY_ORDER, self._set_multi_sz, [
-            GUID_WINDOWS_MEMORY_TESTER
-        ])
+        (BCDE_OSLOADER_TYPE_HYPERVISOR_DEBUGGER_TYPE, integer_element(0x0)),
+        (BCDE_OSLOADER_TYPE_HYPERVISOR_DEBUGGER_PORT_NUMBER, integer_element(0x1)),
+        (BCDE_OSLOADER_TYPE_HYPERVISOR_DEBUGGER_BAUDRATE, integer_element(115200)),
+    ]),
+    BCDObject('windows_bootmgr', GUID_WINDOWS_BOOTMGR, OBJECT_TYPE_WINDOWS_BOOTMGR, [
+        (BCDE_LIBRARY_TYPE_APPLICATION_DEVICE, device_element(EFI_DEVICE_SLOT)),
+        (BCDE_LIBRARY_TYPE_APPLICATION_PATH, string_element(r'\EFI\Microsoft\Boot\bootmgfw.efi')),
+        (BCDE_LIBRARY_TYPE_DESCRIPTION, string_element(r'Windows Boot Manager')),
+        (BCDE_LIBRARY_TYPE_PREFERRED_LOCALE, string_element(LOCALE)),
+        (BCDE_LIBRARY_TYPE_INHERIT, guid_list_element([GUID_GLOBAL_SETTINGS_GROUP])),
+        (BCDE_BOOTMGR_TYPE_DEFAULT_OBJECT, guid_element(DEFAULT_LOADER_SLOT)),
+        (BCDE_BOOTMGR_TYPE_RESUME_OBJECT, guid_element(DEFAULT_RESUME_SLOT)),
+        (BCDE_BOOTMGR_TYPE_DISPLAY_ORDER, guid_list_element([DISPLAY_ORDER_SLOT])),
+        (BCDE_BOOTMGR_TYPE_TOOLS_DISPLAY_ORDER, guid_list_element([GUID_WINDOWS_MEMORY_TESTER])),
         # 30 seconds timeout
-        self._create_element(obj_node, BCDE_BOOTMGR_TYPE_TIMEOUT, self._set_binary, pack_uint64(30))
-
-    def _create_firmware_bootmgr(self):
-        obj_node = self._create_object(GUID_FIRMWARE_BOOTMGR, OBJECT_TYPE_FIRMWARE_BOOTMGR)
-        self._create_element(obj_node, BCDE_BOOTMGR_TYPE_DISPLAY_ORDER, self._set_multi_sz, [
-            GUID_WINDOWS_BOOTMGR
-        ])
-        self._create_element(obj_node, BCDE_BOOTMGR_TYPE_TIMEOUT, self._set_binary, pack_uint64(0))
-
-    def _create_windows_memory_tester(self):
-        obj_node = self._create_object(GUID_WINDOWS_MEMORY_TESTER, OBJECT_TYPE_WINDOWS_MEMORY_TESTER)
-        self._create_element(obj_node, BCDE_LIBRARY_TYPE_APPLICATION_DEVICE, self._set_binary,
-                             create_device_value(self.disk_uuid, self.efi_part_uuid))
-        self._create_element(obj_node, BCDE_LIBRARY_TYPE_APPLICATION_PATH, self._set_sz,
-                             r'\EFI\Microsoft\Boot\memtest.efi')
-        self._create_element(obj_node, BCDE_LIBRARY_TYPE_DESCRIPTION, self._set_sz, r'Windows Memory Diagnostic')
-        self._create_element(obj_node, BCDE_LIBRARY_TYPE_PREFERRED_LOCALE, self._set_sz, LOCALE)
-        self._create_element(obj_node, BCDE_LIBRARY_TYPE_INHERIT, self._set_multi_sz, [
-            GUID_GLOBAL_SETTINGS_GROUP
-        ])
-        self._create_element(obj_node, BCDE_LIBRARY_TYPE_ALLOW_BAD_MEMORY_ACCESS, self._set_binary, b'\x01')
-
-    def _create_windows_resume(self):
-        obj_node = self._create_object(format_uuid(self.resume_uuid), OBJECT_TYPE_WINDOWS_RESUME)
-        self._create_element(obj_node, BCDE_LIBRARY_TYPE_APPLICATION_DEVICE, self._set_binary,
-                             create_device_value(self.disk_uuid, self.win_part_uuid))
-        self._create_element(obj_node, BCDE_LIBRARY_TYPE_APPLICATION_PATH, self._set_sz,
-                             r'\windows\system32\winresume.efi')
-        self._create_element(obj_node, BCDE_LIBRARY_TYPE_DESCRIPTION, self._set_sz, r'Windows Resume Application')
-        self._create_element(obj_node, BCDE_LIBRARY_TYPE_PREFERRED_LOCALE, self._set_sz, LOCALE)
-        self._create_element(obj_node, BCDE_LIBRARY_TYPE_INHERIT, self._set_multi_sz, [
-            GUID_RESUME_LOADER_SETTINGS_GROUP
-        ])
-        self._create_element(obj_node, BCDE_LIBRARY_TYPE_ISOLATED_EXECUTION_CONTEXT, self._set_binary, b'\x01')
+        (BCDE_BOOTMGR_TYPE_TIMEOUT, integer_element(30)),
+    ]),
+    BCDObject('firmware_bootmgr', GUID_FIRMWARE_BOOTMGR, OBJECT_TYPE_FIRMWARE_BOOTMGR, [
+        (BCDE_BOOTMGR_TYPE_DISPLAY_ORDER, guid_list_element([GUID_WINDOWS_BOOTMGR])),
+        (BCDE_BOOTMGR_TYPE_TIMEOUT, integer_element(0)),
+    ]),
+    BCDObject('windows_memory_tester', GUID_WINDOWS_MEMORY_TESTER, OBJECT_TYPE_WINDOWS_MEMORY_TESTER, [
+        (BCDE_LIBRARY_TYPE_APPLICATION_DEVICE, device_element(EFI_DEVICE_SLOT)),
+        (BCDE_LIBRARY_TYPE_APPLICATION_PATH, string_element(r'\EFI\Microsoft\Boot\memtest.efi')),
+        (BCDE_LIBRARY_TYPE_DESCRIPTION, string_element(r'Windows Memory Diagnostic')),
+        (BCDE_LIBRARY_TYPE_PREFERRED_LOCALE, string_element(LOCALE)),
+        (BCDE_LIBRARY_TYPE_INHERIT, guid_list_element([GUID_GLOBAL_SETTINGS_GROUP])),
+        (BCDE_LIBRARY_TYPE_ALLOW_BAD_MEMORY_ACCESS, boolean_element(True)),
+    ]),
+], [
+    BCDObject('windows_resume', RESUME_SLOT, OBJECT_TYPE_WINDOWS_RESUME, [
+        (BCDE_LIBRARY_TYPE_APPLICATION_DEVICE, device_element(OS_DEVICE_SLOT)),
+        (BCDE_LIBRARY_TYPE_APPLICATION_PATH, string_element((SYSTEM_ROOT_SLOT, r'\system32\winresume.efi'))),
+        (BCDE_LIBRARY_TYPE_DESCRIPTION, string_element(r'Windows Resume Application')),
+        (BCDE_LIBRARY_TYPE_PREFERRED_LOCALE, string_element(LOCALE)),
+        (BCDE_LIBRARY_TYPE_INHERIT, guid_list_element([GUID_RESUME_LOADER_SETTINGS_GROUP])),
+        (BCDE_LIBRARY_TYPE_ISOLATED_EXECUTION_CONTEXT, boolean_element(True)),
         # 0x15000075 is ???
-        self._create_element(obj_node, BCDE_LIBRARY_TYPE_ALLOWED_IN_MEMORY_SETTINGS, self._set_binary,
-                             pack_uint64(0x15000075))
-        self._create_element(obj_node, BCDE_RESUME_LOADER_TYPE_HIBERFILE_PATH, self._set_sz, r'\hiberfil.sys')
+        (BCDE_LIBRARY_TYPE_ALLOWED_IN_MEMORY_SETTINGS, integer_list_element([0x15000075])),
+        (BCDE_RESUME_LOADER_TYPE_HIBERFILE_PATH, string_element(r'\hiberfil.sys')),
         # 1 is the standard boot menu policy
-        self._create_element(obj_node, BCDE_RESUME_LOADER_TYPE_BOOT_MENU_POLICY, self._set_binary, pack_uint64(0x1))
-
-    def _create_windows_loader(self):
-        obj_node = self._create_object(format_uuid(self.loader_uuid), OBJECT_TYPE_WINDOWS_RESUME)
-        device = create_device_value(self.disk_uuid, self.win_part_uuid)
-        self._create_element(obj_node, BCDE_LIBRARY_TYPE_APPLICATION_DEVICE, self._set_binary,
-                             device)
-        self._create_element(obj_node, BCDE_LIBRARY_TYPE_APPLICATION_PATH, self._set_sz,
-                             r'\windows\system32\winload.efi')
-        self._create_element(obj_node, BCDE_LIBRARY_TYPE_DESCRIPTION, self._set_sz, r'Windows 10')
-        self._create_element(obj_node, BCDE_LIBRARY_TYPE_PREFERRED_LOCALE, self._set_sz, LOCALE)
-        self._create_element(obj_node, BCDE_LIBRARY_TYPE_INHERIT, self._set_multi_sz, [
-            GUID_BOOT_LOADER_SETTINGS_GROUP
-        ])
-        self._create_element(obj_node, BCDE_LIBRARY_TYPE_ISOLATED_EXECUTION_CONTEXT, self._set_binary, b'\x01')
+        (BCDE_RESUME_LOADER_TYPE_BOOT_MENU_POLICY, integer_element(0x1)),
+    ]),
+    BCDObject('windows_loader', LOADER_SLOT, OBJECT_TYPE_WINDOWS_LOADER, [
+        (BCDE_LIBRARY_TYPE_APPLICATION_DEVICE, device_element(OS_DEVICE_SLOT)),
+        (BCDE_LIBRARY_TYPE_APPLICATION_PATH, string_element((SYSTEM_ROOT_SLOT, r'\system32\winload.efi'))),
+        (BCDE_LIBRARY_TYPE_DESCRIPTION, string_element(DESCRIPTION_SLOT)),
+        (BCDE_LIBRARY_TYPE_PREFERRED_LOCALE, string_element(LOCALE)),
+        (BCDE_LIBRARY_TYPE_INHERIT, guid_list_element([GUID_BOOT_LOADER_SETTINGS_GROUP])),
+        (BCDE_LIBRARY_TYPE_ISOLATED_EXECUTION_CONTEXT, boolean_element(True)),
         # 0x15000075 is ???
-        self._create_element(obj_node, BCDE_LIBRARY_TYPE_ALLOWED_IN_MEMORY_SETTINGS, self._set_binary,
-                             pack_uint64(0x15000075))
-        self._create_element(obj_node, BCDE_OSLOADER_TYPE_OS_DEVICE, self._set_binary, device)
-        self._create_element(obj_node, BCDE_OSLOADER_TYPE_SYSTEM_ROOT, self._set_sz, r'\windows')
-        self._create_element(obj_node, BCDE_OSLOADER_TYPE_ASSOCIATED_RESUME_OBJECT, self._set_sz,
-                             format_uuid(self.resume_uuid))
+        (BCDE_LIBRARY_TYPE_ALLOWED_IN_MEMORY_SETTINGS, integer_list_element([0x15000075])),
+        (BCDE_OSLOADER_TYPE_OS_DEVICE, device_element(OS_DEVICE_SLOT)),
+        (BCDE_OSLOADER_TYPE_SYSTEM_ROOT, string_element(SYSTEM_ROOT_SLOT)),
+        (BCDE_OSLOADER_TYPE_ASSOCIATED_RESUME_OBJECT, guid_element(RESUME_SLOT)),
         # 0 is opt in
-        self._create_element(obj_node, BCDE_OSLOADER_TYPE_NX_POLICY, self._set_binary, pack_uint64(0))
+        (BCDE_OSLOADER_TYPE_NX_POLICY, integer_element(0)),
         # 1 is standard
-        self._create_element(obj_node, BCDE_OSLOADER_TYPE_BOOT_MENU_POLICY, self._set_binary, pack_uint64(0x1))
+        (BCDE_OSLOADER_TYPE_BOOT_MENU_POLICY, integer_element(0x1)),
+    ]),
+])
+
+
+def write_image(out, data):
+    """Write a store image into a binary file object or a writable buffer, return its size."""
+    if hasattr(out, 'write'):
+        out.write(data)
+        return len(data)
+    view = memoryview(out).cast('B')
+    if len(view) < len(data):
+        raise ValueError(f'buffer of {len(view)} bytes is too small for a {len(data)} byte store')
+    view[:len(data)] = data
+    return len(data)
+
+
+LoaderEntry = namedtuple('LoaderEntry', 'loader_uuid resume_uuid device description system_root')
+
+
+class BCD:
+    def __init__(self, target_file, disk_uuid, efi_part_uuid, win_part_uuid, backend=None, schema=None,
+                 deterministic=False, metrics=None):
+        self.target_file = target_file
+        self.disk_uuid = disk_uuid
+        self.efi_part_uuid = efi_part_uuid
+        self.win_part_uuid = win_part_uuid
+
+        self.backend = backend or DEFAULT_BACKEND
+        self.schema = schema or DEFAULT_SCHEMA
+        # derive loader/resume GUIDs from the disk layout, so that the same inputs give the same store
+        self.deterministic = deterministic
+        self.hive = open_hive(self.backend, deterministic)
+        self.root = self.hive.root()
+        self._built = False
+        # calls into the hive backend for this store, each one an FFI crossing with hivex
+        self.hive_calls = 0
+        # opt-in metrics.BuildMetrics (or any object with its observe_* methods), None measures nothing
+        self.metrics = metrics
+
+        # GUIDs of the first loader entry and its resume entry
+        if deterministic:
+            self.loader_uuid, self.resume_uuid = deterministic_uuids(disk_uuid, efi_part_uuid, win_part_uuid)
+        else:
+            self.loader_uuid = uuid.uuid4()
+            self.resume_uuid = uuid.uuid4()
+        self.loaders = []
+        self.default_loader = 0
+
+    def add_loader(self, part_uuid=None, description=r'Windows 10', system_root=r'\windows', resume=True,
+                   default=False, device=None):
+        """Add a Windows loader entry, paired with a resume entry unless resume is False, and return its GUID.
+
+        The loader boots partition part_uuid (the Windows partition if not given) of the store's disk;
+        pass device to boot from any other device element data, e.g. a VHD. Entries are shown in the
+        order they were added and the first one is the default unless another one is added with
+        default=True. Without any add_loader() call the store gets one entry for the Windows partition.
+        """
+        if device is None:
+            device = create_device_value(self.disk_uuid, part_uuid or self.win_part_uuid)
+        if self.loaders and self.deterministic:
+            loader_uuid = derive_uuid('loader', self.disk_uuid, device.hex(), len(self.loaders))
+            resume_uuid = derive_uuid('resume', self.disk_uuid, device.hex(), len(self.loaders))
+        elif self.loaders:
+            loader_uuid, resume_uuid = uuid.uuid4(), uuid.uuid4()
+        else:
+            loader_uuid, resume_uuid = self.loader_uuid, self.resume_uuid
+        if default:
+            self.default_loader = len(self.loaders)
+        self.loaders.append(LoaderEntry(loader_uuid, resume_uuid if resume else None, device, description,
+                                        system_root))
+        return loader_uuid
+
+    @staticmethod
+    def open(store_file):
+        """Open an existing store for targeted changes instead of building a new one, see edit_bcd.BCDEditor."""
+        from edit_bcd import BCDEditor
+        return BCDEditor(store_file)
 
+    def create(self):
+        if self.target_file is None:
+            raise ValueError('BCD has no target_file, use to_bytes() or write_to()')
+        self._build()
+        start = time.perf_counter() if self.metrics is not None else None
+        self._commit(self.target_file)
+        if self.metrics is not None:
+            elapsed = time.perf_counter() - start
+            # the backend serializes and writes the hive in one call
+            self.metrics.observe_phase('commit', elapsed)
+            self.metrics.observe_output(elapsed, path.getsize(self.target_file))
+
+    def to_bytes(self):
+        """Return the finished store as a regf image without writing to target_file."""
+        self._build()
+        start = time.perf_counter() if self.metrics is not None else None
+        if self.backend == 'regf':
+            data = self.hive.to_bytes()
+        else:
+            fd, scratch = tempfile.mkstemp(suffix='.bcd', dir=SCRATCH_DIR)
+            try:
+                os.close(fd)
+                self._commit(scratch)
+                with open(scratch, 'rb') as f:
+                    data = f.read()
+            finally:
+                os.unlink(scratch)
+        if self.metrics is not None:
+            self.metrics.observe_phase('commit', time.perf_counter() - start)
+        return data
+
+    def write_to(self, out):
+        """Write the finished store into a binary file object or a writable buffer.
+
+        Returns the number of bytes written.
+        """
+        data = self.to_bytes()
+        start = time.perf_counter() if self.metrics is not None else None
+        size = write_image(out, data)
+        if self.metrics is not None:
+            self.metrics.observe_output(time.perf_counter() - start, size)
+        return size
+
+    def _commit(self, target_file):
+        self.hive.commit(target_file)
+        self.hive_calls += 1
+        if self.metrics is not None:
+            self.metrics.observe_calls('commit', 1)
+
+    def _slots(self):
+        """Per-store values of the schema slots, each computed once."""
+        default = self.loaders[self.default_loader]
+        return {
+            EFI_DEVICE_SLOT.name: create_device_value(self.disk_uuid, self.efi_part_uuid),
+            DEFAULT_LOADER_SLOT.name: format_uuid(default.loader_uuid),
+            DEFAULT_RESUME_SLOT.name: format_uuid(default.resume_uuid) if default.resume_uuid else None,
+            # items of a REG_MULTI_SZ are separated by a null character
+            DISPLAY_ORDER_SLOT.name: '\x00'.join(format_uuid(e.loader_uuid) for e in self.loaders),
+        }
+
+    @staticmethod
+    def _loader_slots(entry):
+        return {
+            LOADER_SLOT.name: format_uuid(entry.loader_uuid),
+            RESUME_SLOT.name: format_uuid(entry.resume_uuid) if entry.resume_uuid else None,
+            OS_DEVICE_SLOT.name: entry.device,
+            DESCRIPTION_SLOT.name: entry.description,
+            SYSTEM_ROOT_SLOT.name: entry.system_root,
+        }
+
+    def _build(self):
+        if self._built:
+            return
+        if not self.loaders:
+            self.add_loader()
+        nodes = {(): self.root}
+        metrics = self.metrics
+        if metrics is None:
+            self._write_plan(self.schema.plan(), self._slots(), nodes)
+            self._write_loaders(nodes)
+        else:
+            # time every phase on its own
+            slots = self._slots()
+            for phase in self.schema.plan():
+                start = time.perf_counter()
+                self._write_plan([phase], slots, nodes)
+                metrics.observe_phase(phase[0], time.perf_counter() - start)
+            start = time.perf_counter()
+            self._write_loaders(nodes)
+            metrics.observe_phase('loaders', time.perf_counter() - start)
+            metrics.observe_store()
+        self._built = True
+
+    def _write_loaders(self, nodes):
+        for entry in self.loaders:
+            self._write_plan(self.schema.loader_plan(entry.resume_uuid is not None), self._loader_slots(entry),
+                             nodes)
+
+    def _write_plan(self, plan, names, nodes):
+        """Create the keys and values of a plan; values referring to a slot that is None are left out.
+
+        Every key still costs one node_add_child and, if it has values, one node_set_values: the
+        hivex API has no call that creates several keys at once, so an object's calls are only
+        made back to back in its plan phase, not batched into fewer calls.
+        """
+        encoded = {name: value.encode('utf-16-le') if isinstance(value, str) else value
+                   for name, value in names.items()}
+        hive = self.hive
+        # element format -> bytes of value data, only counted with metrics
+        value_bytes = {} if self.metrics is not None else None
+        adds = sets = 0
+        for _, entries in plan:
+            for node_path, dynamic, values, fill in entries:
+                if fill:
+                    values = _fill_values(values, encoded)
+                    if values is None:
+                        continue
+                if dynamic:
+                    node_path = tuple(names[p.name] if type(p) is Slot else p for p in node_path)
+                node = nodes[node_path] = hive.node_add_child(nodes[node_path[:-1]], node_path[-1])
+                adds += 1
+                if values:
+                    # one call for all values of the key
+                    hive.node_set_values(node, values)
+                    sets += 1
+                    if value_bytes is not None and node_path[-2:-1] == (CONST_ELEMENTS,):
+                        name = ELEMENT_FORMAT_NAMES.get(int(node_path[-1], 16) & ELEMENT_FORMAT_MASK, 'other')
+                        value_bytes[name] = value_bytes.get(name, 0) + sum(len(v['value']) for v in values)
+        self.hive_calls += adds + sets
+        if value_bytes is not None:
+            self.metrics.observe_calls('node_add_child', adds)
+            self.metrics.observe_calls('node_set_values', sets)
+            for name, size in value_bytes.items():
+                self.metrics.observe_value_bytes(name, size)
+
+
+def _fill_values(values, encoded):
+    filled = []
+    for value in values:
+        if type(value['value']) is not bytes:
+            parts = [p if type(p) is bytes else encoded[p.name] for p in value['value']]
+            if None in parts:
+                return None
+            value = dict(value, value=b''.join(parts))
+        filled.append(value)
+    return filled
+
+
+# Placeholder values the template is compiled with, their bytes are located and patched per store
+TEMPLATE_SLOTS = {
+    'disk': uuid.UUID('af10d65b-b12f-418c-a9a4-bf7535fe104a'),
+    'efi_part': uuid.UUID('90d31ced-2ef6-4771-a0ba-22d4f2f2e8b2'),
+    'win_part': uuid.UUID('abd287d5-2610-4107-bb9a-ebdf64a5d812'),
+    'loader': uuid.UUID('5c630bcb-26ef-4f23-99ef-81f6b339b448'),
+    'resume': uuid.UUID('57a0c1f6-ab94-4154-8459-b32d9b6c2f02'),
+}
+
+
+def _slot_encodings(slot, uuid_val):
+    """Byte representations of a slot as they appear in the serialized hive."""
+    if slot in ('loader', 'resume'):
+        # key names under Objects are stored as ASCII, element values as REG_SZ/REG_MULTI_SZ
+        guid = format_uuid(uuid_val)
+        return [guid.encode('ascii'), guid.encode('utf-16-le')]
+    return [uuid_to_device_id(uuid_val)]
+
+
+class BCDTemplate:
+    """A BCD store built once through a hive backend and stamped out per machine by byte patching.
+
+    All per-machine data has a fixed size, so a new store is a copy of the compiled image with the
+    GUIDs written over their recorded offsets, the Objects subkey list re-sorted for the new key
+    names and the header checksum fixed up. A deterministic template is compiled with the fixed
+    timestamps of a deterministic BCD, so with the regf backend every compile gives the same image.
+    """
+
+    def __init__(self, image, sites, objects_offset):
+        self.image = image
+        self.sites = sites
+        self.objects_offset = objects_offset
+
+    @classmethod
+    def compile(cls, backend=None, schema=None, metrics=None, deterministic=False):
+        started = time.perf_counter() if metrics is not None else None
+        bcd = BCD(None, TEMPLATE_SLOTS['disk'], TEMPLATE_SLOTS['efi_part'], TEMPLATE_SLOTS['win_part'], backend,
+                  schema, deterministic)
+        bcd.loader_uuid = TEMPLATE_SLOTS['loader']
+        bcd.resume_uuid = TEMPLATE_SLOTS['resume']
+        image = bcd.to_bytes()
+
+        sites = []
+        for slot, uuid_val in TEMPLATE_SLOTS.items():
+            for encoding, pattern in enumerate(_slot_encodings(slot, uuid_val)):
+                start = image.find(pattern)
+                if start == -1:
+                    raise ValueError(f'template slot {slot} not found in the compiled hive')
+                while start != -1:
+                    sites.append((start, slot, encoding))
+                    start = image.find(pattern, start + len(pattern))
+        objects_offset = regf.find_subkey(image, regf.root_offset(image), 'Objects')
+        if metrics is not None:
+            metrics.observe_template_load(time.perf_counter() - started)
+        return cls(image, sites, objects_offset)
+
+    def render(self, disk_uuid, efi_part_uuid, win_part_uuid, loader_uuid=None, resume_uuid=None, metrics=None):
+        started = time.perf_counter() if metrics is not None else None
+        values = {
+            'disk': disk_uuid,
+            'efi_part': efi_part_uuid,
+            'win_part': win_part_uuid,
+            'loader': loader_uuid or uuid.uuid4(),
+            'resume': resume_uuid or uuid.uuid4(),
+        }
+        encoded = {slot: _slot_encodings(slot, uuid_val) for slot, uuid_val in values.items()}
+        buf = bytearray(self.image)
+        for start, slot, encoding in self.sites:
+            data = encoded[slot][encoding]
+            buf[start:start + len(data)] = data
+        regf.sort_subkeys(buf, self.objects_offset)
+        regf.update_checksum(buf)
+        if metrics is not None:
+            metrics.observe_phase('render', time.perf_counter() - started)
+            metrics.observe_store()
+        return bytes(buf)
+
+    def create(self, target_file, disk_uuid, efi_part_uuid, win_part_uuid, loader_uuid=None, resume_uuid=None,
+               metrics=None):
+        data = self.render(disk_uuid, efi_part_uuid, win_part_uuid, loader_uuid, resume_uuid, metrics)
+        start = time.perf_counter() if metrics is not None else None
+        with open(target_file, 'wb') as f:
+            f.write(data)
+        if metrics is not None:
+            metrics.observe_output(time.perf_counter() - start, len(data))
+
+    def write_to(self, out, disk_uuid, efi_part_uuid, win_part_uuid, loader_uuid=None, resume_uuid=None,
+                 metrics=None):
+        """Like BCD.write_to(), for a store rendered from this template."""
+        data = self.render(disk_uuid, efi_part_uuid, win_part_uuid, loader_uuid, resume_uuid, metrics)
+        start = time.perf_counter() if metrics is not None else None
+        size = write_image(out, data)
+        if metrics is not None:
+            metrics.observe_output(time.perf_counter() - start, size)
+        return size
+
+
+_default_templates = {}
+
+
+def default_template(backend=None, metrics=None, deterministic=False):
+    """The compiled template for a backend, built once per process; metrics sees that one compile."""
+    template = _default_templates.get((backend, deterministic))
+    if template is None:
+        template = _default_templates[backend, deterministic] = BCDTemplate.compile(
+            backend, metrics=metrics, deterministic=deterministic)
+    return template
+
+
+class StoreCache:
+    """On-disk cache of finished stores, addressed by a hash of everything that determines their bytes.
+
+    Stores are built with deterministic GUIDs, so with the regf backend a hit is exactly the store a
+    rebuild would give. hivex stamps keys with the time they were written, so there a hit only
+    differs from a rebuild in those timestamps.
+    When the cache grows beyond max_bytes, the least recently used stores are evicted. Entries are
+    written atomically, so several processes can share one cache directory. Each process re-reads
+    the size of the directory from disk after every max_bytes / 16 it writes itself, so n processes
+    sharing it overshoot max_bytes by at most n / 16 of it before one of them evicts.
+    """
+
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        # bytes in the directory as of the last scan plus what this process wrote since
+        self._size = 0
+        self._written = 0
+        self.evict()
+
+    @staticmethod
+    def key(disk_uuid, efi_part_uuid, win_part_uuid, backend=None, schema=None):
+        schema = schema or DEFAULT_SCHEMA
+        material = [SCHEMA_VERSION, schema.fingerprint(), backend or DEFAULT_BACKEND,
+                    disk_uuid, efi_part_uuid, win_part_uuid]
+        return hashlib.sha256('/'.join(map(str, material)).encode()).hexdigest()
+
+    def _path(self, key):
+        return path.join(self.directory, key[:2], key + '.bcd')
+
+    def get(self, key):
+        store_file = self._path(key)
+        try:
+            with open(store_file, 'rb') as f:
+                data = f.read()
+            # the modification time doubles as the last use for LRU eviction
+            os.utime(store_file)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def put(self, key, data):
+        store_file = self._path(key)
+        os.makedirs(path.dirname(store_file), exist_ok=True)
+        try:
+            replaced = os.stat(store_file).st_size
+        except FileNotFoundError:
+            replaced = 0
+        replace_file(store_file, data)
+        self._size += len(data) - replaced
+        self._written += len(data)
+        # what other processes wrote only shows on disk
+        if self._size > self.max_bytes or self._written >= self.max_bytes // 16:
+            self.evict()
+
+    def get_or_create(self, disk_uuid, efi_part_uuid, win_part_uuid, backend=None, schema=None, metrics=None):
+        """Return the store for the inputs, building and caching it on a miss."""
+        key = self.key(disk_uuid, efi_part_uuid, win_part_uuid, backend, schema)
+        data = self.get(key)
+        if data is None:
+            data = BCD(None, disk_uuid, efi_part_uuid, win_part_uuid, backend, schema, deterministic=True,
+                       metrics=metrics).to_bytes()
+            self.put(key, data)
+        return data
+
+    def _entries(self):
+        """(mtime, path, size) of every store and temporary file in the cache."""
+        for sub in os.scandir(self.directory):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.endswith(('.bcd', '.tmp')):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    yield stat.st_mtime, entry.path, stat.st_size
+
+    def evict(self):
+        """Re-read the cache size from disk and remove least recently used stores until it is below 90% of max_bytes.
+
+        Temporary files of writers that died before renaming them are removed once they are older
+        than STALE_TMP_SECONDS.
+        """
+        stale = time.time() - STALE_TMP_SECONDS
+        stores = []
+        self._size = self._written = 0
+        for mtime, entry_file, size in self._entries():
+            if entry_file.endswith('.tmp'):
+                if mtime < stale:
+                    _remove_file(entry_file)
+                    continue
+            else:
+                stores.append((mtime, entry_file, size))
+            self._size += size
+        for _, store_file, size in sorted(stores):
+            if self._size <= self.max_bytes * 0.9:
+                break
+            _remove_file(store_file)
+            self._size -= size
+
+
+# temporary files in a StoreCache older than this are left over from a crashed writer
+STALE_TMP_SECONDS = 3600
+
+
+def _remove_file(filename):
+    try:
+        os.unlink(filename)
+    except FileNotFoundError:
+        pass
+
+
+@lru_cache(maxsize=None)
+def _store_cache(directory):
+    return StoreCache(directory)
+
+
+MANIFEST_FIELDS = ('disk_uuid', 'efi_part_uuid', 'win_part_uuid', 'output_path')
+
+BatchResult = namedtuple('BatchResult', 'index output_path error')
+
+
+def read_manifest(manifest_file):
+    """Yield manifest rows one at a time from a CSV (with header) or JSONL file.
+
+    JSONL lines are yielded unparsed, so that a malformed line only fails its own row in
+    parse_manifest_row().
+    """
+    with open(manifest_file, newline='') as f:
+        if manifest_file.endswith('.csv'):
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield line
+
+
+def parse_manifest_row(row):
+    """Return a manifest row as a dict, parsing JSONL lines; raise ValueError for anything else."""
+    if isinstance(row, str):
+        try:
+            row = json.loads(row)
+        except json.JSONDecodeError as e:
+            raise ValueError(f'malformed manifest row: {e}') from None
+    if not isinstance(row, dict):
+        raise ValueError(f'manifest row is not an object: {row!r}')
+    return row
+
+
+def manifest_row_uuids(row):
+    """(output_path, disk_uuid, efi_part_uuid, win_part_uuid) of a parsed manifest row, ValueError if incomplete."""
+    missing = [field for field in MANIFEST_FIELDS if not row.get(field)]
+    if missing:
+        raise ValueError(f'manifest row is missing {", ".join(missing)}')
+    for field in MANIFEST_FIELDS:
+        if not isinstance(row[field], str):
+            raise ValueError(f'manifest field {field} is not a string: {row[field]!r}')
+    return (row['output_path'], uuid.UUID(row['disk_uuid']), uuid.UUID(row['efi_part_uuid']),
+            uuid.UUID(row['win_part_uuid']))
+
+
+def _create_from_row(row, use_template=False, backend=None, deterministic=False, cache_dir=None,
+                     collect_metrics=False):
+    metrics = BuildMetrics() if collect_metrics else None
+    output_path, *uuids = manifest_row_uuids(row)
+    if cache_dir is not None:
+        data = _store_cache(cache_dir).get_or_create(*uuids, backend, metrics=metrics)
+        start = time.perf_counter() if metrics is not None else None
+        with open(output_path, 'wb') as f:
+            f.write(data)
+        if metrics is not None:
+            metrics.observe_output(time.perf_counter() - start, len(data))
+    elif use_template:
+        loader_resume = deterministic_uuids(*uuids) if deterministic else (None, None)
+        template = default_template(backend, metrics, deterministic)
+        template.create(output_path, *uuids, *loader_resume, metrics=metrics)
+    else:
+        BCD(output_path, *uuids, backend=backend, deterministic=deterministic, metrics=metrics).create()
+    return metrics
+
+
+def create_batch(rows, max_workers=None, max_pending=None, use_template=False, backend=None, deterministic=False,
+                 cache_dir=None, metrics=None):
+    """Create one BCD store per manifest row across a process pool.
+
+    Yields a BatchResult per row as soon as it finishes, in completion order. A failing row only
+    sets the error field of its own result. At most max_pending rows are read ahead of the
+    workers, so the manifest is never held in memory as a whole. With use_template every worker
+    compiles a BCDTemplate once and patches it per row instead of rebuilding the hive. With
+    cache_dir, stores are taken from (and added to) a StoreCache shared by all workers. The
+    workers' measurements of every successful row are merged into metrics, a BuildMetrics.
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if max_pending is None:
+        max_pending = 4 * max_workers
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        pending = {}
+        for index, row in enumerate(rows):
+            try:
+                row = parse_manifest_row(row)
+            except ValueError as e:
+                yield BatchResult(index, None, e)
+                continue
+            if len(pending) >= max_pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                yield from _collect_batch_results(pending, done, metrics)
+            pending[executor.submit(_create_from_row, row, use_template, backend, deterministic, cache_dir,
+                                     metrics is not None)] = (index, row.get('output_path'))
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            yield from _collect_batch_results(pending, done, metrics)
+
+
+def _collect_batch_results(pending, done, metrics):
+    for future in done:
+        index, output_path = pending.pop(future)
+        error = future.exception()
+        if error is None and metrics is not None:
+            metrics.merge(future.result())
+        yield BatchResult(index, output_path, error)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Create BCD stores for UEFI Windows installations.')
+    parser.add_argument('--manifest', help='CSV or JSONL manifest with one store per row, columns: '
+                                           + ', '.join(MANIFEST_FIELDS))
+    parser.add_argument('--workers', type=int, default=None, help='worker processes for --manifest')
+    parser.add_argument('--template', action='store_true',
+                        help='compile the store once per worker and patch it per row')
+    parser.add_argument('--backend', choices=BACKENDS, default=None,
+                        help=f'hive writer to use (default: {DEFAULT_BACKEND})')
+    parser.add_argument('--deterministic', action='store_true',
+                        help='derive loader/resume GUIDs from the disk layout instead of random ones')
+    parser.add_argument('--cache-dir', default=None,
+                        help='content-addressed store cache for --manifest, implies --deterministic')
+    parser.add_argument('--metrics-file', default=None,
+                        help='write build metrics to this file in the Prometheus text format')
+    parser.add_argument('--openmetrics', action='store_true', help='write --metrics-file as OpenMetrics')
+    args = parser.parse_args(argv)
+    metrics = BuildMetrics() if args.metrics_file else None
+
+    if args.manifest:
+        failed = 0
+        for result in create_batch(read_manifest(args.manifest), max_workers=args.workers,
+                                   use_template=args.template, backend=args.backend,
+                                   deterministic=args.deterministic, cache_dir=args.cache_dir, metrics=metrics):
+            if result.error is not None:
+                failed += 1
+                print(f'row {result.index} ({result.output_path}): {result.error}', file=sys.stderr)
+            else:
+                print(result.output_path)
+        if metrics is not None:
+            metrics.write_textfile(args.metrics_file, args.openmetrics)
+        return 1 if failed else 0
 
-def main():
-    shutil.copy('minimal', 'target')
     # disk_uuid = uuid.UUID('533fc85c-e6b6-4bd4-b5cd-4badc4b98d06')
     disk_uuid = uuid.UUID('f470029f-14da-41dc-a2ac-f14b055d4a92')
     # efi_part_uuid = uuid.UUID('8cd00792-e072-44aa-babe-ec71c6e27205')
     efi_part_uuid = uuid.UUID('e9cc797b-4481-4f8d-910c-a7295adc39f1')
     # win_part_uuid = uuid.UUID('d218db09-4505-4f72-b670-0683ee7d8036')
     win_part_uuid = uuid.UUID('45847f60-f197-48fd-893c-060eb28b4202')
-    bcd = BCD('target', disk_uuid, efi_part_uuid, win_part_uuid)
+    bcd = BCD('target', disk_uuid, efi_part_uuid, win_part_uuid, args.backend, deterministic=args.deterministic,
+              metrics=metrics)
     bcd.create()
+    if metrics is not None:
+        metrics.write_textfile(args.metrics_file, args.openmetrics)
+    return 0
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
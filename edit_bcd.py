@@ -0,0 +1,168 @@
+"""Targeted changes to existing BCD stores, see BCD.open()."""
+import os
+
+import regf
+from atomic_file import replace_file
+from create_bcd import (BCDE_BOOTMGR_TYPE_DEFAULT_OBJECT, BCDE_BOOTMGR_TYPE_TIMEOUT, CONST_DESC, CONST_ELEMENT,
+                        CONST_ELEMENTS, ELEMENT_FORMAT_DEVICE, GUID_WINDOWS_BOOTMGR, REG_DWORD, _join_parts,
+                        device_element, guid_element, integer_element, parse_device_value, uuid_to_device_id)
+from read_bcd import BCDStore, element_format
+
+
+def _element_data(value):
+    data = _join_parts(value.parts)
+    if type(data) is not bytes:
+        raise ValueError('element values of an existing store cannot refer to slots')
+    return data
+
+
+class BCDEditor:
+    """An existing store opened for targeted changes.
+
+    As long as only values of unchanged size and type are set, the new bytes are written over the
+    old value data and save() writes just those byte ranges back to the file. Any other change
+    (adding or removing objects and elements, values of a different size) loads the hive into a
+    regf.Hive and save() writes it out again as a whole. Objects and elements the editor doesn't
+    touch, including ones other tools added, are kept either way, and so are the last written
+    times and security descriptors of the keys it doesn't change.
+    """
+
+    def __init__(self, store_file):
+        self.store_file = store_file
+        self._load()
+
+    def _load(self):
+        with open(self.store_file, 'rb') as f:
+            self.buf = bytearray(f.read())
+        self.store = BCDStore(self.buf)
+        # (position, size) of every in-place change since the last save
+        self._patches = []
+        # the whole hive, once a change needed it
+        self._hive = None
+
+    @property
+    def rewrite_needed(self):
+        return self._hive is not None
+
+    def _tree(self):
+        if self._hive is None:
+            self._hive = regf.Hive.load(self.buf)
+        return self._hive
+
+    def _objects_node(self):
+        hive = self._tree()
+        return hive.node_get_child(hive.root(), 'Objects')
+
+    def _object_node(self, guid):
+        node = self._tree().node_get_child(self._objects_node(), guid)
+        if node is None:
+            raise KeyError(guid)
+        return node
+
+    def set_element(self, guid, element_type, value):
+        """Set an element to an ElementValue, e.g. from create_bcd.integer_element()."""
+        data = _element_data(value)
+        if self._hive is None:
+            obj = self.store.objects.get(guid.lower())
+            if obj is None:
+                raise KeyError(guid)
+            if element_type.lower() in obj.element_offsets:
+                vk = obj.element_offsets[element_type.lower()]
+                pos, size = regf.vk_data_position(self.buf, vk)
+                if pos is not None and size == len(data) and regf.vk_type(self.buf, vk) == value.value_type:
+                    self.buf[pos:pos + size] = data
+                    self._patches.append((pos, size))
+                    return
+        hive = self._tree()
+        obj = self._object_node(guid)
+        elements = hive.node_get_child(obj, CONST_ELEMENTS)
+        if elements is None:
+            elements = hive.node_add_child(obj, CONST_ELEMENTS)
+        element = hive.node_get_child(elements, element_type)
+        if element is None:
+            element = hive.node_add_child(elements, element_type)
+        hive.node_set_value(element, {'key': CONST_ELEMENT, 't': value.value_type, 'value': data})
+
+    def remove_element(self, guid, element_type):
+        hive = self._tree()
+        elements = hive.node_get_child(self._object_node(guid), CONST_ELEMENTS)
+        element = hive.node_get_child(elements, element_type) if elements is not None else None
+        if element is None:
+            raise KeyError(element_type)
+        hive.node_delete_child(element)
+
+    def add_object(self, guid, type_dword, elements=()):
+        hive = self._tree()
+        obj = hive.node_add_child(self._objects_node(), guid)
+        desc = hive.node_add_child(obj, CONST_DESC)
+        hive.node_set_value(desc, {'key': 'Type', 't': REG_DWORD, 'value': type_dword.to_bytes(4, 'little')})
+        hive.node_add_child(obj, CONST_ELEMENTS)
+        for element_type, value in elements:
+            self.set_element(guid, element_type, value)
+
+    def remove_object(self, guid):
+        self._tree().node_delete_child(self._object_node(guid))
+
+    def set_timeout(self, seconds):
+        self.set_element(GUID_WINDOWS_BOOTMGR, BCDE_BOOTMGR_TYPE_TIMEOUT, integer_element(seconds))
+
+    def set_default_object(self, guid):
+        self.set_element(GUID_WINDOWS_BOOTMGR, BCDE_BOOTMGR_TYPE_DEFAULT_OBJECT, guid_element(guid))
+
+    def _device_elements(self):
+        if self._hive is None:
+            for obj in self.store:
+                for element_type in obj:
+                    if element_format(element_type) == ELEMENT_FORMAT_DEVICE:
+                        yield obj.guid, element_type, obj[element_type].data
+            return
+        hive = self._hive
+        for obj in hive.node_children(self._objects_node()):
+            elements = hive.node_get_child(obj, CONST_ELEMENTS)
+            for element in hive.node_children(elements) if elements is not None else ():
+                element_type = hive.node_name(element)
+                if element_format(element_type) != ELEMENT_FORMAT_DEVICE:
+                    continue
+                for key, _, data in hive.node_values(element):
+                    if key.upper() == CONST_ELEMENT.upper():
+                        yield hive.node_name(obj), element_type, data
+
+    def rewrite_devices(self, disk_uuid=None, partitions=None):
+        """Point qualified-partition device elements at a new disk and/or new partitions.
+
+        partitions maps old partition UUIDs to new ones. Device values keep their size, so this
+        is an in-place change. Returns the number of rewritten elements.
+        """
+        partitions = partitions or {}
+        changes = []
+        for guid, element_type, data in self._device_elements():
+            device = parse_device_value(data)
+            if device.part_uuid is None:
+                continue
+            new = bytearray(data)
+            if disk_uuid is not None:
+                new[0x38:0x38 + 16] = uuid_to_device_id(disk_uuid)
+            if device.part_uuid in partitions:
+                new[0x20:0x20 + 16] = uuid_to_device_id(partitions[device.part_uuid])
+            if new != data:
+                changes.append((guid, element_type, bytes(new)))
+        for guid, element_type, data in changes:
+            self.set_element(guid, element_type, device_element(data))
+        return len(changes)
+
+    def save(self, target_file=None):
+        """Write the changes to target_file, by default the opened store."""
+        target_file = target_file or self.store_file
+        if self._hive is not None:
+            replace_file(target_file, self._hive.to_bytes())
+        elif target_file != self.store_file:
+            replace_file(target_file, self.buf)
+        elif self._patches:
+            with open(target_file, 'r+b') as f:
+                for pos, size in self._patches:
+                    os.pwrite(f.fileno(), self.buf[pos:pos + size], pos)
+        if target_file == self.store_file:
+            if self._hive is not None:
+                self._load()
+            self._patches = []
+
@@ -0,0 +1,131 @@
+"""Find the disk and partition GUIDs a BCD store needs in a raw disk image.
+
+Only the protective MBR, the GPT header and the partition entry array are read, through a
+read-only memory map, so the size of the image doesn't matter.
+"""
+import argparse
+import mmap
+import struct
+import sys
+import uuid
+import zlib
+from collections import namedtuple
+
+from create_bcd import BCD
+from read_bcd import map_files
+
+GUID_EFI_SYSTEM_PARTITION = uuid.UUID('c12a7328-f81f-11d2-ba4b-00a0c93ec93b')
+GUID_MICROSOFT_BASIC_DATA = uuid.UUID('ebd0a0a2-b9e5-4433-87c0-68b6b72699c7')
+
+GPT_SIGNATURE = b'EFI PART'
+MBR_SIGNATURE = b'\x55\xaa'
+MBR_TYPE_PROTECTIVE = 0xee
+SECTOR_SIZES = (512, 4096)
+
+# signature, revision, header size, header crc32, reserved, current lba, backup lba, first usable lba,
+# last usable lba, disk guid, partition entries lba, number of entries, entry size, entries crc32
+GPT_HEADER = struct.Struct('<8sIIIIQQQQ16sQIII')
+# type guid, partition guid, first lba, last lba, attributes, name
+GPT_ENTRY = struct.Struct('<16s16sQQQ72s')
+
+GptPartition = namedtuple('GptPartition', 'type_uuid part_uuid first_lba last_lba attributes name')
+GptDisk = namedtuple('GptDisk', 'disk_uuid sector_size partitions')
+
+
+def _parse_header(buf, pos):
+    if len(buf) < pos + GPT_HEADER.size or buf[pos:pos + 8] != GPT_SIGNATURE:
+        return None
+    fields = GPT_HEADER.unpack_from(buf, pos)
+    header_size = fields[2]
+    if not GPT_HEADER.size <= header_size <= 512:
+        return None
+    header = bytearray(buf[pos:pos + header_size])
+    header[16:20] = b'\x00\x00\x00\x00'
+    if zlib.crc32(header) != fields[3]:
+        return None
+    return fields
+
+
+def _parse_entries(buf, fields, sector_size):
+    entries_lba, count, entry_size, entries_crc = fields[10:14]
+    start = entries_lba * sector_size
+    end = start + count * entry_size
+    if entry_size < GPT_ENTRY.size or end > len(buf) or zlib.crc32(buf[start:end]) != entries_crc:
+        return None
+    partitions = []
+    for pos in range(start, end, entry_size):
+        type_guid, part_guid, first_lba, last_lba, attributes, name = GPT_ENTRY.unpack_from(buf, pos)
+        if type_guid == bytes(16):
+            continue
+        partitions.append(GptPartition(uuid.UUID(bytes_le=type_guid), uuid.UUID(bytes_le=part_guid), first_lba,
+                                       last_lba, attributes, name.decode('utf-16-le').split('\x00', 1)[0]))
+    return partitions
+
+
+def parse_gpt(buf):
+    """Parse the GPT of a disk image given as a buffer, falling back to the backup header."""
+    if buf[510:512] != MBR_SIGNATURE or not any(buf[446 + 16 * i + 4] == MBR_TYPE_PROTECTIVE for i in range(4)):
+        raise ValueError('no protective MBR')
+    for sector_size in SECTOR_SIZES:
+        for header_pos in (sector_size, len(buf) - sector_size):
+            fields = _parse_header(buf, header_pos)
+            if fields is None:
+                continue
+            partitions = _parse_entries(buf, fields, sector_size)
+            if partitions is not None:
+                return GptDisk(uuid.UUID(bytes_le=fields[9]), sector_size, partitions)
+    raise ValueError('no valid GPT header')
+
+
+def read_gpt(image_file):
+    with open(image_file, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            return parse_gpt(buf)
+
+
+def find_windows_partitions(disk):
+    """(efi_part_uuid, win_part_uuid): the first EFI system partition and the largest basic data partition."""
+    esp = next((p for p in disk.partitions if p.type_uuid == GUID_EFI_SYSTEM_PARTITION), None)
+    data = [p for p in disk.partitions if p.type_uuid == GUID_MICROSOFT_BASIC_DATA]
+    if esp is None:
+        raise ValueError('no EFI system partition')
+    if not data:
+        raise ValueError('no Microsoft basic data partition')
+    win = max(data, key=lambda p: p.last_lba - p.first_lba)
+    return esp.part_uuid, win.part_uuid
+
+
+def discover(image_file):
+    """(disk_uuid, efi_part_uuid, win_part_uuid) of a disk image, ready to be passed to BCD."""
+    disk = read_gpt(image_file)
+    return (disk.disk_uuid,) + find_windows_partitions(disk)
+
+
+def bcd_from_image(image_file, target_file=None, **kwargs):
+    """A BCD for the Windows installation on a disk image, keyword arguments are passed to BCD."""
+    return BCD(target_file, *discover(image_file), **kwargs)
+
+
+def discover_batch(image_files, max_workers=None, chunksize=16):
+    """Yield a read_bcd.ScanResult with the discover() result per image, in order, using a process pool."""
+    yield from map_files(discover, ((image_file,) for image_file in image_files), max_workers, chunksize)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Print the disk, EFI and Windows partition GUIDs of disk images.')
+    parser.add_argument('images', nargs='+', help='raw disk image files')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes')
+    args = parser.parse_args(argv)
+
+    failed = 0
+    for result in discover_batch(args.images, max_workers=args.workers):
+        if result.error is not None:
+            failed += 1
+            print(f'{result.path}: {result.error}', file=sys.stderr)
+        else:
+            print(result.path, *result.result)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
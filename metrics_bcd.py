@@ -0,0 +1,104 @@
+"""Opt-in build metrics of BCD stores and their export as a Prometheus or OpenMetrics text file.
+
+BCD, BCDTemplate and create_batch() only measure anything when given a metrics object, which
+is any object with the observe_* methods of BuildMetrics. Without one they skip all timing.
+"""
+from atomic_file import replace_file
+
+
+class BuildMetrics:
+    """Totals over all stores built with this object, mergeable across processes."""
+
+    def __init__(self):
+        self.stores = 0
+        # phase -> seconds and number of times it ran
+        self.phase_seconds = {}
+        self.phase_runs = {}
+        # hive backend call -> count
+        self.calls = {}
+        # element format name -> bytes of value data
+        self.value_bytes = {}
+        self.template_loads = 0
+        self.template_load_seconds = 0.0
+        self.outputs = 0
+        self.output_seconds = 0.0
+        self.output_bytes = 0
+
+    def observe_store(self):
+        self.stores += 1
+
+    def observe_phase(self, phase, seconds):
+        self.phase_seconds[phase] = self.phase_seconds.get(phase, 0.0) + seconds
+        self.phase_runs[phase] = self.phase_runs.get(phase, 0) + 1
+
+    def observe_calls(self, call, count):
+        self.calls[call] = self.calls.get(call, 0) + count
+
+    def observe_value_bytes(self, element_format, size):
+        self.value_bytes[element_format] = self.value_bytes.get(element_format, 0) + size
+
+    def observe_template_load(self, seconds):
+        self.template_loads += 1
+        self.template_load_seconds += seconds
+
+    def observe_output(self, seconds, size):
+        self.outputs += 1
+        self.output_seconds += seconds
+        self.output_bytes += size
+
+    def merge(self, other):
+        """Add the totals of another BuildMetrics, e.g. one returned by a worker process."""
+        self.stores += other.stores
+        for phase, seconds in other.phase_seconds.items():
+            self.phase_seconds[phase] = self.phase_seconds.get(phase, 0.0) + seconds
+            self.phase_runs[phase] = self.phase_runs.get(phase, 0) + other.phase_runs[phase]
+        for call, count in other.calls.items():
+            self.observe_calls(call, count)
+        for element_format, size in other.value_bytes.items():
+            self.observe_value_bytes(element_format, size)
+        self.template_loads += other.template_loads
+        self.template_load_seconds += other.template_load_seconds
+        self.outputs += other.outputs
+        self.output_seconds += other.output_seconds
+        self.output_bytes += other.output_bytes
+
+    def _families(self):
+        # (name, help, label, {label value: sample} or a single sample)
+        return [
+            ('bcd_stores', 'BCD stores built.', None, self.stores),
+            ('bcd_phase_seconds', 'Time spent per build phase.', 'phase', self.phase_seconds),
+            ('bcd_phase_runs', 'Times a build phase ran.', 'phase', self.phase_runs),
+            ('bcd_hive_calls', 'Calls into the hive backend.', 'call', self.calls),
+            ('bcd_value_bytes', 'Bytes of element value data written per element format.', 'format',
+             self.value_bytes),
+            ('bcd_template_loads', 'Templates compiled.', None, self.template_loads),
+            ('bcd_template_load_seconds', 'Time spent compiling templates.', None, self.template_load_seconds),
+            ('bcd_outputs', 'Stores written to files or buffers.', None, self.outputs),
+            ('bcd_output_seconds', 'Time spent writing stores.', None, self.output_seconds),
+            ('bcd_output_bytes', 'Bytes of stores written.', None, self.output_bytes),
+        ]
+
+    def to_text(self, openmetrics=False):
+        """The totals as counters in the Prometheus text exposition format, or OpenMetrics."""
+        lines = []
+        for name, help_text, label, samples in self._families():
+            family = name if openmetrics else name + '_total'
+            lines.append(f'# HELP {family} {help_text}')
+            lines.append(f'# TYPE {family} counter')
+            if label is None:
+                lines.append(f'{name}_total {samples}')
+                continue
+            for label_value, sample in sorted(samples.items()):
+                lines.append(f'{name}_total{{{label}="{_escape_label(label_value)}"}} {sample}')
+        if openmetrics:
+            lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, filename, openmetrics=False):
+        """Atomically replace filename with to_text(), as the node_exporter textfile collector expects."""
+        # world readable, the collector usually runs as another user
+        replace_file(filename, self.to_text(openmetrics).encode(), 0o644)
+
+
+def _escape_label(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
@@ -0,0 +1,270 @@
+"""Read existing BCD stores through a memory-mapped object index.
+
+Opening a store only walks Objects\\{guid}\\Description\\Type and the key names below Elements;
+element values are decoded on first access, according to the format encoded in their BCDE type.
+"""
+import argparse
+import mmap
+import os
+import struct
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import regf
+from create_bcd import (BCDE_BOOTMGR_TYPE_DEFAULT_OBJECT, CONST_DESC, CONST_ELEMENT, CONST_ELEMENTS,
+                        ELEMENT_FORMAT_BOOLEAN, ELEMENT_FORMAT_DEVICE, ELEMENT_FORMAT_GUID, ELEMENT_FORMAT_GUID_LIST,
+                        ELEMENT_FORMAT_INTEGER, ELEMENT_FORMAT_INTEGER_LIST, ELEMENT_FORMAT_MASK, ELEMENT_FORMAT_STRING,
+                        GUID_WINDOWS_BOOTMGR, parse_device_value)
+
+
+def element_format(element_type):
+    return int(element_type, 16) & ELEMENT_FORMAT_MASK
+
+
+def _decode_string(data):
+    return data.decode('utf-16-le').split('\x00', 1)[0]
+
+
+def _decode_string_list(data):
+    return [s for s in data.decode('utf-16-le').split('\x00') if s]
+
+
+def _decode_integer(data):
+    return int.from_bytes(data[:8], 'little')
+
+
+def _decode_integer_list(data):
+    return list(struct.unpack(f'<{len(data) // 8}Q', data[:len(data) // 8 * 8]))
+
+
+def _decode_boolean(data):
+    return any(data)
+
+
+ELEMENT_DECODERS = {
+    ELEMENT_FORMAT_DEVICE: parse_device_value,
+    ELEMENT_FORMAT_STRING: _decode_string,
+    ELEMENT_FORMAT_GUID: _decode_string,
+    ELEMENT_FORMAT_GUID_LIST: _decode_string_list,
+    ELEMENT_FORMAT_INTEGER: _decode_integer,
+    ELEMENT_FORMAT_BOOLEAN: _decode_boolean,
+    ELEMENT_FORMAT_INTEGER_LIST: _decode_integer_list,
+}
+
+
+class BCDElement:
+    """One element of an object; `value` decodes the registry data on first access."""
+    __slots__ = ('store', 'element_type', 'vk', '_value')
+
+    def __init__(self, store, element_type, vk):
+        self.store = store
+        self.element_type = element_type
+        self.vk = vk
+        self._value = None
+
+    @property
+    def value_type(self):
+        return regf.vk_type(self.store.buf, self.vk)
+
+    @property
+    def data(self):
+        return regf.vk_data(self.store.buf, self.vk)
+
+    @property
+    def value(self):
+        if self._value is None:
+            decoder = ELEMENT_DECODERS.get(element_format(self.element_type))
+            self._value = decoder(self.data) if decoder else self.data
+        return self._value
+
+
+class BCDStoreObject:
+    __slots__ = ('store', 'guid', 'type_dword', 'element_offsets', '_elements')
+
+    def __init__(self, store, guid, type_dword, element_offsets):
+        self.store = store
+        self.guid = guid
+        self.type_dword = type_dword
+        # BCDE type -> offset of its Element value
+        self.element_offsets = element_offsets
+        self._elements = {}
+
+    def __contains__(self, element_type):
+        return element_type.lower() in self.element_offsets
+
+    def __iter__(self):
+        return iter(self.element_offsets)
+
+    def __len__(self):
+        return len(self.element_offsets)
+
+    def __getitem__(self, element_type):
+        element_type = element_type.lower()
+        element = self._elements.get(element_type)
+        if element is None:
+            element = self._elements[element_type] = BCDElement(self.store, element_type,
+                                                                self.element_offsets[element_type])
+        return element
+
+    def get(self, element_type, default=None):
+        if element_type not in self:
+            return default
+        return self[element_type].value
+
+
+class BCDStore:
+    """Object index of a BCD store, keyed by lower-case object GUID.
+
+    `buf` may be any buffer, open() maps a file read-only and close() unmaps it again.
+    """
+
+    def __init__(self, buf):
+        if bytes(buf[:4]) != b'regf':
+            raise ValueError('not a registry hive')
+        self.buf = buf
+        self.objects = {}
+        root = regf.root_offset(buf)
+        objects = regf.find_subkey(buf, root, 'Objects')
+        if objects is None:
+            raise ValueError('hive has no Objects key')
+        for obj in regf.subkey_offsets(buf, objects):
+            guid = regf.nk_name(buf, obj).lower()
+            type_dword = None
+            element_offsets = {}
+            for child in regf.subkey_offsets(buf, obj):
+                name = regf.nk_name(buf, child)
+                if name.upper() == CONST_DESC.upper():
+                    vk = regf.find_value(buf, child, 'Type')
+                    if vk is not None:
+                        pos, size = regf.vk_data_position(buf, vk)
+                        type_dword = int.from_bytes(buf[pos:pos + min(size, 4)], 'little')
+                elif name.upper() == CONST_ELEMENTS.upper():
+                    for element in regf.subkey_offsets(buf, child):
+                        vk = regf.find_value(buf, element, CONST_ELEMENT)
+                        if vk is not None:
+                            element_offsets[regf.nk_name(buf, element).lower()] = vk
+            self.objects[guid] = BCDStoreObject(self, guid, type_dword, element_offsets)
+
+    @classmethod
+    def open(cls, store_file):
+        with open(store_file, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return cls(buf)
+        except Exception:
+            buf.close()
+            raise
+
+    def close(self):
+        if isinstance(self.buf, mmap.mmap):
+            self.buf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __contains__(self, guid):
+        return guid.lower() in self.objects
+
+    def __getitem__(self, guid):
+        return self.objects[guid.lower()]
+
+    def __iter__(self):
+        return iter(self.objects.values())
+
+
+def summarize(store):
+    """Default per-store result of scan_stores()."""
+    bootmgr = store.objects.get(GUID_WINDOWS_BOOTMGR)
+    return {
+        'objects': len(store.objects),
+        'elements': sum(len(obj) for obj in store),
+        'default_object': bootmgr.get(BCDE_BOOTMGR_TYPE_DEFAULT_OBJECT) if bootmgr else None,
+    }
+
+
+ScanResult = namedtuple('ScanResult', 'path result error')
+
+# what a damaged or foreign file raises while it is parsed
+SCAN_ERRORS = (OSError, ValueError, struct.error, IndexError, UnicodeDecodeError)
+
+
+def _run_one(func, job):
+    file, *args = job
+    try:
+        return ScanResult(file, func(file, *args), None)
+    except SCAN_ERRORS as e:
+        return ScanResult(file, None, e)
+
+
+def map_files(func, jobs, max_workers=None, chunksize=64):
+    """Yield a ScanResult with func(file, *args) per (file, *args) job, in order, using a process pool.
+
+    func must be picklable, e.g. a module level function. Files it fails to parse (SCAN_ERRORS)
+    yield a result with the error set.
+    """
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        yield from executor.map(_run_one, repeat(func), jobs, chunksize=chunksize)
+
+
+def rate_summary(count, elapsed, failed, noun='stores'):
+    return f'{count} {noun} in {elapsed:.2f}s ({count / elapsed:.1f} {noun}/s), {failed} failed'
+
+
+def _scan_store(store_file, func):
+    with BCDStore.open(store_file) as store:
+        return func(store)
+
+
+def iter_store_files(directory):
+    for entry in os.scandir(directory):
+        if entry.is_file():
+            yield entry.path
+
+
+def expand_paths(paths):
+    """The files among paths plus the files in the directories among them."""
+    store_files = []
+    for p in paths:
+        store_files.extend(iter_store_files(p) if os.path.isdir(p) else [p])
+    return store_files
+
+
+def scan_stores(store_files, func=summarize, max_workers=None, chunksize=64):
+    """Open every store and yield a ScanResult with func(store) per file, using a process pool.
+
+    func must be picklable, e.g. a module level function. Files that cannot be parsed yield a
+    result with the error set.
+    """
+    yield from map_files(_scan_store, ((store_file, func) for store_file in store_files), max_workers, chunksize)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Index BCD stores and report stores per second.')
+    parser.add_argument('paths', nargs='+', help='BCD store files or directories of them')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes')
+    parser.add_argument('-v', '--verbose', action='store_true', help='print the summary of every store')
+    args = parser.parse_args(argv)
+
+    store_files = expand_paths(args.paths)
+
+    start = time.perf_counter()
+    failed = 0
+    for result in scan_stores(store_files, max_workers=args.workers):
+        if result.error is not None:
+            failed += 1
+            print(f'{result.path}: {result.error}', file=sys.stderr)
+        elif args.verbose:
+            print(f'{result.path}: {result.result}')
+    elapsed = time.perf_counter() - start
+    print(rate_summary(len(store_files), elapsed, failed))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,488 @@
+import struct
+import time
+
+# The base block is followed by the hive bins; every cell offset in the hive is relative to HBIN_START.
+HBIN_START = 0x1000
+ROOT_CELL_OFFSET = 0x24
+CHECKSUM_OFFSET = 0x1fc
+
+NK_FLAG_COMP_NAME = 0x20
+NK_FLAGS = 0x02
+NK_SUBKEY_COUNT = 0x14
+NK_SUBKEY_LIST = 0x1c
+NK_VALUE_COUNT = 0x24
+NK_VALUE_LIST = 0x28
+NK_NAME_LENGTH = 0x48
+NK_NAME = 0x4c
+
+VK_NAME_LENGTH = 0x02
+VK_DATA_SIZE = 0x04
+VK_DATA = 0x08
+VK_TYPE = 0x0c
+VK_FLAGS = 0x10
+VK_NAME = 0x14
+VK_DATA_INLINE = 0x8000_0000
+VK_FLAG_COMP_NAME = 0x1
+# biggest value that still fits into a single data cell, larger ones are split into 'db' segments of this size
+MAX_DATA_SIZE = 16344
+
+INVALID_OFFSET = 0xffff_ffff
+
+
+def header_checksum(buf):
+    checksum = 0
+    for dword in struct.unpack_from('<127I', buf, 0):
+        checksum ^= dword
+    if checksum == 0xffff_ffff:
+        return 0xffff_fffe
+    if checksum == 0:
+        return 1
+    return checksum
+
+
+def update_checksum(buf):
+    struct.pack_into('<I', buf, CHECKSUM_OFFSET, header_checksum(buf))
+
+
+def header_timestamp(buf):
+    return struct.unpack_from('<Q', buf, 0x0c)[0]
+
+
+def cell_data(offset):
+    """File position of the data of the cell at hive offset `offset` (after its size field)."""
+    return HBIN_START + offset + 4
+
+
+def root_offset(buf):
+    return struct.unpack_from('<I', buf, ROOT_CELL_OFFSET)[0]
+
+
+def nk_name(buf, offset):
+    pos = cell_data(offset)
+    flags, = struct.unpack_from('<H', buf, pos + NK_FLAGS)
+    length, = struct.unpack_from('<H', buf, pos + NK_NAME_LENGTH)
+    raw = bytes(buf[pos + NK_NAME:pos + NK_NAME + length])
+    return raw.decode('latin-1' if flags & NK_FLAG_COMP_NAME else 'utf-16-le')
+
+
+def name_hash(name):
+    """Hash stored next to each entry of an 'lh' subkey list."""
+    h = 0
+    for c in name.upper():
+        h = (h * 37 + ord(c)) & 0xffff_ffff
+    return h
+
+
+def _leaf_entries(buf, list_offset):
+    pos = cell_data(list_offset)
+    sig = bytes(buf[pos:pos + 2])
+    count, = struct.unpack_from('<H', buf, pos + 2)
+    if sig in (b'lf', b'lh'):
+        return sig, [struct.unpack_from('<I', buf, pos + 4 + 8 * i)[0] for i in range(count)]
+    if sig in (b'li', b'ri'):
+        return sig, list(struct.unpack_from(f'<{count}I', buf, pos + 4))
+    raise ValueError(f'unknown subkey list signature {sig!r} at 0x{list_offset:x}')
+
+
+def subkey_offsets(buf, offset):
+    """Offsets of the nk cells of all subkeys of the key at `offset`, in stored order."""
+    pos = cell_data(offset)
+    count, = struct.unpack_from('<I', buf, pos + NK_SUBKEY_COUNT)
+    if not count:
+        return []
+    sig, entries = _leaf_entries(buf, struct.unpack_from('<I', buf, pos + NK_SUBKEY_LIST)[0])
+    if sig != b'ri':
+        return entries
+    result = []
+    for sub_list in entries:
+        result.extend(_leaf_entries(buf, sub_list)[1])
+    return result
+
+
+def find_subkey(buf, offset, name):
+    name = name.upper()
+    for child in subkey_offsets(buf, offset):
+        if nk_name(buf, child).upper() == name:
+            return child
+    return None
+
+
+def value_offsets(buf, offset):
+    """Offsets of the vk cells of all values of the key at `offset`."""
+    pos = cell_data(offset)
+    count, list_offset = struct.unpack_from('<II', buf, pos + NK_VALUE_COUNT)
+    if not count:
+        return ()
+    return struct.unpack_from(f'<{count}I', buf, cell_data(list_offset))
+
+
+def vk_name(buf, offset):
+    pos = cell_data(offset)
+    length, = struct.unpack_from('<H', buf, pos + VK_NAME_LENGTH)
+    flags, = struct.unpack_from('<H', buf, pos + VK_FLAGS)
+    raw = bytes(buf[pos + VK_NAME:pos + VK_NAME + length])
+    return raw.decode('latin-1' if flags & VK_FLAG_COMP_NAME else 'utf-16-le')
+
+
+def vk_type(buf, offset):
+    return struct.unpack_from('<I', buf, cell_data(offset) + VK_TYPE)[0]
+
+
+def vk_data_position(buf, offset):
+    """(file position, size) of the data of a value stored inline or in a single data cell.
+
+    The position is None for values split into 'db' segments, read those with vk_data().
+    """
+    pos = cell_data(offset)
+    size, data_offset = struct.unpack_from('<II', buf, pos + VK_DATA_SIZE)
+    if size & VK_DATA_INLINE:
+        return pos + VK_DATA, size & ~VK_DATA_INLINE
+    if size > MAX_DATA_SIZE and bytes(buf[cell_data(data_offset):cell_data(data_offset) + 2]) == b'db':
+        return None, size
+    return cell_data(data_offset), size
+
+
+def vk_data(buf, offset):
+    pos, size = vk_data_position(buf, offset)
+    if pos is not None:
+        return bytes(buf[pos:pos + size])
+    db_pos = cell_data(struct.unpack_from('<I', buf, cell_data(offset) + VK_DATA)[0])
+    count, segment_list = struct.unpack_from('<HI', buf, db_pos + 2)
+    chunks = []
+    for segment in struct.unpack_from(f'<{count}I', buf, cell_data(segment_list)):
+        chunk = min(MAX_DATA_SIZE, size)
+        chunks.append(bytes(buf[cell_data(segment):cell_data(segment) + chunk]))
+        size -= chunk
+    return b''.join(chunks)
+
+
+def find_value(buf, offset, name):
+    name = name.upper()
+    for value in value_offsets(buf, offset):
+        if vk_name(buf, value).upper() == name:
+            return value
+    return None
+
+
+def sort_subkeys(buf, offset):
+    """Re-sort the subkey list of the key at `offset` after subkey names were patched in place.
+
+    Only single-level lf/lh/li lists are supported, which is what hives of BCD size use.
+    """
+    pos = cell_data(offset)
+    list_offset, = struct.unpack_from('<I', buf, pos + NK_SUBKEY_LIST)
+    sig, entries = _leaf_entries(buf, list_offset)
+    if sig == b'ri':
+        raise ValueError('sorting of indexed (ri) subkey lists is not supported')
+    named = sorted(((nk_name(buf, child), child) for child in entries), key=lambda e: e[0].upper())
+    list_pos = cell_data(list_offset) + 4
+    for i, (name, child) in enumerate(named):
+        if sig == b'li':
+            struct.pack_into('<I', buf, list_pos + 4 * i, child)
+        elif sig == b'lh':
+            struct.pack_into('<II', buf, list_pos + 8 * i, child, name_hash(name))
+        else:
+            hint = name.encode('latin-1', 'replace')[:4].ljust(4, b'\x00')
+            struct.pack_into('<I4s', buf, list_pos + 8 * i, child, hint)
+
+
+REG_NONE = 0
+REG_SZ = 1
+REG_EXPAND_SZ = 2
+REG_BINARY = 3
+REG_DWORD = 4
+REG_MULTI_SZ = 7
+REG_QWORD = 11
+
+HBIN_SIZE = 0x1000
+HBIN_HEADER_SIZE = 0x20
+NK_SIZE = 0x4c
+VK_SIZE = 0x14
+NK_SECURITY = 0x2c
+NK_PARENT = 0x10
+NK_TIMESTAMP = 0x04
+
+
+def filetime(seconds=None):
+    """Current (or the given unix) time as a Windows FILETIME."""
+    if seconds is None:
+        seconds = time.time()
+    return int((seconds + 11644473600) * 10_000_000)
+
+
+def _align(size):
+    return (size + 7) & ~7
+
+
+def _encode_name(name):
+    try:
+        return name.encode('ascii'), True
+    except UnicodeEncodeError:
+        return name.encode('utf-16-le'), False
+
+
+def _sk_cell(buf, offset):
+    """Contents of the sk cell the key at `offset` refers to."""
+    sk_pos = cell_data(struct.unpack_from('<I', buf, cell_data(offset) + NK_SECURITY)[0])
+    sk_size = -struct.unpack_from('<i', buf, sk_pos - 4)[0]
+    return bytes(buf[sk_pos:sk_pos - 4 + sk_size])
+
+
+class Hive:
+    """In-memory key tree serialized to a regf image without libhivex.
+
+    Implements the subset of the hivex.Hivex API that BCD uses, so it can be used as a drop-in
+    backend. Nodes are plain integer handles. The template hive only contributes its base block,
+    root key name and root security descriptor. New keys share the security descriptor of their
+    parent and are stamped with `timestamp`, as are keys whose values or subkeys change. Keys
+    read by load() keep their own descriptor and last written time.
+    """
+
+    def __init__(self, template, timestamp=None):
+        self.template = template
+        self.timestamp = filetime() if timestamp is None else timestamp
+        root = root_offset(template)
+        root_pos = cell_data(root)
+        self._root_flags, = struct.unpack_from('<H', template, root_pos + NK_FLAGS)
+        self._root_parent, = struct.unpack_from('<I', template, root_pos + NK_PARENT)
+        # contents of the distinct sk cells, referred to by index
+        self._sks = [_sk_cell(template, root)]
+
+        self._names = [nk_name(template, root)]
+        self._parents = [None]
+        self._children = [[]]
+        # upper-cased name -> node for the children of every node
+        self._child_index = [{}]
+        self._values = [[]]
+        # sk index and last written FILETIME of every node, None for the hive's timestamp
+        self._security = [0]
+        self._timestamps = [None]
+
+    @classmethod
+    def load(cls, image, timestamp=None):
+        """Read all keys and values of an existing hive, e.g. to change its structure and write it again."""
+        hive = cls(image, timestamp)
+        # sk cell offset in image -> index in hive._sks
+        sks = {}
+        stack = [(root_offset(image), hive.root())]
+        while stack:
+            offset, node = stack.pop()
+            hive._values[node] = [(vk_name(image, vk), vk_type(image, vk), vk_data(image, vk))
+                                  for vk in value_offsets(image, offset)]
+            for child in subkey_offsets(image, offset):
+                stack.append((child, hive.node_add_child(node, nk_name(image, child))))
+            pos = cell_data(offset)
+            sk = struct.unpack_from('<I', image, pos + NK_SECURITY)[0]
+            if sk not in sks:
+                sks[sk] = len(hive._sks)
+                hive._sks.append(_sk_cell(image, offset))
+            hive._security[node] = sks[sk]
+            hive._timestamps[node] = struct.unpack_from('<Q', image, pos + NK_TIMESTAMP)[0]
+        return hive
+
+    def root(self):
+        return 0
+
+    def node_name(self, node):
+        return self._names[node]
+
+    def node_children(self, node):
+        return list(self._children[node])
+
+    def node_get_child(self, node, name):
+        return self._child_index[node].get(name.upper())
+
+    def node_add_child(self, parent, name):
+        index = self._child_index[parent]
+        if name.upper() in index:
+            raise ValueError(f'key {name!r} already exists')
+        node = index[name.upper()] = len(self._names)
+        self._names.append(name)
+        self._parents.append(parent)
+        self._children.append([])
+        self._child_index.append({})
+        self._values.append([])
+        self._security.append(self._security[parent])
+        self._timestamps.append(None)
+        self._children[parent].append(node)
+        self._timestamps[parent] = None
+        return node
+
+    def node_delete_child(self, node):
+        """Remove a key and everything below it from its parent."""
+        parent = self._parents[node]
+        if parent is None:
+            raise ValueError('cannot delete the root key')
+        self._children[parent].remove(node)
+        del self._child_index[parent][self._names[node].upper()]
+        self._timestamps[parent] = None
+
+    def node_values(self, node):
+        return list(self._values[node])
+
+    def node_set_values(self, node, values):
+        self._values[node] = [(v['key'], v['t'], bytes(v['value'])) for v in values]
+        self._timestamps[node] = None
+
+    def node_set_value(self, node, value):
+        values = self._values[node]
+        key = value['key'].upper()
+        entry = (value['key'], value['t'], bytes(value['value']))
+        self._timestamps[node] = None
+        for i, (existing, _, _) in enumerate(values):
+            if existing.upper() == key:
+                values[i] = entry
+                return
+        values.append(entry)
+
+    def commit(self, filename):
+        with open(filename, 'wb') as f:
+            f.write(self.to_bytes())
+
+    def to_bytes(self):
+        names = [_encode_name(name) for name in self._names]
+        # lh lists are sorted by name, cells are placed in creation order, so the layout of hives
+        # built the same way doesn't depend on their key names (e.g. random object GUIDs)
+        children = [sorted(c, key=lambda child: self._names[child].upper()) for c in self._children]
+        values = [[(_encode_name(key), t, data) for key, t, data in v] for v in self._values]
+
+        # first pass: place every cell, opening a new hbin whenever the current one is full
+        bins = []
+        cursor = bin_end = 0
+
+        def alloc(size):
+            nonlocal cursor, bin_end
+            size = _align(size + 4)
+            if cursor + size > bin_end:
+                bin_size = max(HBIN_SIZE, (HBIN_HEADER_SIZE + size + HBIN_SIZE - 1) & ~(HBIN_SIZE - 1))
+                if bins:
+                    bins[-1] = (bins[-1][0], bin_end - bins[-1][0], cursor)
+                bins.append((bin_end, bin_size, None))
+                cursor = bin_end + HBIN_HEADER_SIZE
+                bin_end += bin_size
+            offset = cursor
+            cursor += size
+            return offset, size
+
+        count = len(self._names)
+        nk_cells = [None] * count
+        list_cells = [None] * count
+        value_list_cells = [None] * count
+        vk_cells = [[] for _ in range(count)]
+
+        stack = [0]
+        order = []
+        # sk index -> cell, in the order they are placed
+        sk_cells = {}
+        while stack:
+            node = stack.pop()
+            order.append(node)
+            nk_cells[node] = alloc(NK_SIZE + len(names[node][0]))
+            if self._security[node] not in sk_cells:
+                sk_cells[self._security[node]] = alloc(len(self._sks[self._security[node]]))
+            if children[node]:
+                list_cells[node] = alloc(4 + 8 * len(children[node]))
+            if values[node]:
+                value_list_cells[node] = alloc(4 * len(values[node]))
+                for (name, _), _, data in values[node]:
+                    vk = alloc(VK_SIZE + len(name))
+                    if len(data) <= 4:
+                        data_cells = None
+                    elif len(data) <= MAX_DATA_SIZE:
+                        data_cells = alloc(len(data))
+                    else:
+                        segments = range(0, len(data), MAX_DATA_SIZE)
+                        data_cells = (alloc(8), alloc(4 * len(segments)),
+                                      [alloc(min(MAX_DATA_SIZE, len(data) - start)) for start in segments])
+                    vk_cells[node].append((vk, data_cells))
+            stack.extend(reversed(self._children[node]))
+        bins[-1] = (bins[-1][0], bin_end - bins[-1][0], cursor)
+
+        # second pass: write everything into one preallocated image
+        buf = bytearray(HBIN_START + bin_end)
+        buf[:HBIN_START] = self.template[:HBIN_START]
+        struct.pack_into('<IIQ', buf, 4, 1, 1, self.timestamp)
+        struct.pack_into('<II', buf, ROOT_CELL_OFFSET, nk_cells[0][0], bin_end)
+        update_checksum(buf)
+        for i, (start, size, used) in enumerate(bins):
+            struct.pack_into('<4sII8xQ', buf, HBIN_START + start, b'hbin', start, size,
+                             self.timestamp if i == 0 else 0)
+            if used < start + size:
+                struct.pack_into('<i', buf, HBIN_START + used, start + size - used)
+
+        def cell(offset_size):
+            offset, size = offset_size
+            struct.pack_into('<i', buf, HBIN_START + offset, -size)
+            return cell_data(offset)
+
+        # the sk cells form a circular list, each counting the keys that refer to it
+        references = {}
+        for node in order:
+            references[self._security[node]] = references.get(self._security[node], 0) + 1
+        sk_list = list(sk_cells.items())
+        for i, (sk, sk_cell) in enumerate(sk_list):
+            sk_pos = cell(sk_cell)
+            buf[sk_pos:sk_pos + len(self._sks[sk])] = self._sks[sk]
+            struct.pack_into('<III', buf, sk_pos + 4, sk_list[(i + 1) % len(sk_list)][1][0],
+                             sk_list[i - 1][1][0], references[sk])
+
+        parents = [None] * count
+        for node in order:
+            name, compressed = names[node]
+            subkeys = children[node]
+            node_values = values[node]
+            for child in subkeys:
+                parents[child] = nk_cells[node][0]
+            if node == 0:
+                flags, parent = self._root_flags, self._root_parent
+            else:
+                flags, parent = NK_FLAG_COMP_NAME if compressed else 0, parents[node]
+            timestamp = self._timestamps[node]
+            pos = cell(nk_cells[node])
+            struct.pack_into('<2sHQ15IHH', buf, pos, b'nk', flags, self.timestamp if timestamp is None else timestamp,
+                             0, parent,
+                             len(subkeys), 0,
+                             list_cells[node][0] if subkeys else INVALID_OFFSET, INVALID_OFFSET,
+                             len(node_values),
+                             value_list_cells[node][0] if node_values else INVALID_OFFSET,
+                             sk_cells[self._security[node]][0], INVALID_OFFSET,
+                             max((len(self._names[c]) * 2 for c in subkeys), default=0), 0,
+                             max((len(key) * 2 for key, _, _ in self._values[node]), default=0),
+                             max((len(data) for _, _, data in node_values), default=0),
+                             0, len(name), 0)
+            buf[pos + NK_SIZE:pos + NK_SIZE + len(name)] = name
+
+            if subkeys:
+                pos = cell(list_cells[node])
+                struct.pack_into('<2sH', buf, pos, b'lh', len(subkeys))
+                for i, child in enumerate(subkeys):
+                    struct.pack_into('<II', buf, pos + 4 + 8 * i, nk_cells[child][0], name_hash(self._names[child]))
+
+            if node_values:
+                list_pos = cell(value_list_cells[node])
+                for i, (((key, compressed_key), t, data), (vk, data_cells)) in enumerate(
+                        zip(node_values, vk_cells[node])):
+                    struct.pack_into('<I', buf, list_pos + 4 * i, vk[0])
+                    pos = cell(vk)
+                    size_field = len(data)
+                    if data_cells is None:
+                        size_field |= 0x8000_0000
+                        data_field = data.ljust(4, b'\x00')
+                    elif len(data) <= MAX_DATA_SIZE:
+                        data_field = struct.pack('<I', data_cells[0])
+                        data_pos = cell(data_cells)
+                        buf[data_pos:data_pos + len(data)] = data
+                    else:
+                        db_cell, segment_list, segments = data_cells
+                        data_field = struct.pack('<I', db_cell[0])
+                        struct.pack_into('<2sHI', buf, cell(db_cell), b'db', len(segments), segment_list[0])
+                        segment_list_pos = cell(segment_list)
+                        for j, segment in enumerate(segments):
+                            struct.pack_into('<I', buf, segment_list_pos + 4 * j, segment[0])
+                            segment_pos = cell(segment)
+                            chunk = data[j * MAX_DATA_SIZE:(j + 1) * MAX_DATA_SIZE]
+                            buf[segment_pos:segment_pos + len(chunk)] = chunk
+                    struct.pack_into('<2sHI4sIHH', buf, pos, b'vk', len(key), size_field, data_field, t,
+                                     VK_FLAG_COMP_NAME if compressed_key else 0, 0)
+                    buf[pos + VK_SIZE:pos + VK_SIZE + len(key)] = key
+        return bytes(buf)
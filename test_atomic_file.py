@@ -0,0 +1,49 @@
+import os
+import stat
+import tempfile
+import unittest
+
+from atomic_file import _umask, replace_file
+
+
+class ReplaceFileTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.target = os.path.join(self.directory.name, 'target')
+        self.umask = os.umask(0o027)
+
+    def tearDown(self):
+        os.umask(self.umask)
+        self.directory.cleanup()
+
+    def mode(self):
+        return stat.S_IMODE(os.stat(self.target).st_mode)
+
+    def test_umask_is_read_without_changing_it(self):
+        self.assertEqual(_umask(), 0o027)
+        self.assertEqual(os.umask(0o027), 0o027)
+
+    def test_new_file_gets_umask_default(self):
+        replace_file(self.target, b'data')
+        self.assertEqual(self.mode(), 0o640)
+
+    def test_replacement_keeps_mode(self):
+        replace_file(self.target, b'old')
+        os.chmod(self.target, 0o600)
+        replace_file(self.target, b'new')
+        self.assertEqual(self.mode(), 0o600)
+        with open(self.target, 'rb') as f:
+            self.assertEqual(f.read(), b'new')
+
+    def test_explicit_mode_is_masked(self):
+        replace_file(self.target, b'data', 0o644)
+        self.assertEqual(self.mode(), 0o640)
+
+    def test_failure_leaves_no_temporary_file(self):
+        with self.assertRaises(TypeError):
+            replace_file(self.target, 'not bytes')
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
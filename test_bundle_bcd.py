@@ -0,0 +1,55 @@
+import io
+import os
+import tempfile
+import unittest
+import uuid
+from contextlib import redirect_stdout
+
+import bundle_bcd
+import create_bcd
+
+
+class BundleTest(unittest.TestCase):
+    def test_round_trip_of_direct_builds(self):
+        with tempfile.TemporaryDirectory() as directory:
+            stores = {}
+            for i in range(40):
+                store_file = os.path.join(directory, f'store{i}.bcd')
+                create_bcd.BCD(store_file, uuid.uuid4(), uuid.uuid4(), uuid.uuid4(), 'regf').create()
+                with open(store_file, 'rb') as f:
+                    stores[f'store{i}'] = f.read()
+            bundle = os.path.join(directory, 'stores.bundle')
+            with redirect_stdout(io.StringIO()):
+                self.assertEqual(bundle_bcd.main(['pack', bundle, directory]), 0)
+            # the stores differ in their GUIDs, device elements and key timestamps only
+            self.assertLess(os.path.getsize(bundle), 0.15 * sum(map(len, stores.values())))
+
+            listing = io.StringIO()
+            with redirect_stdout(listing):
+                self.assertEqual(bundle_bcd.main(['list', bundle]), 0)
+            self.assertEqual(sorted(listing.getvalue().split()), sorted(stores))
+
+            out = os.path.join(directory, 'out')
+            os.mkdir(out)
+            self.assertEqual(bundle_bcd.main(['extract', bundle, '-o', out]), 0)
+            for key, data in stores.items():
+                with open(os.path.join(out, key + '.bcd'), 'rb') as f:
+                    self.assertEqual(f.read(), data)
+            with bundle_bcd.BundleReader(bundle) as reader:
+                self.assertEqual(reader.get('store7'), stores['store7'])
+
+    def test_unsafe_keys_are_not_extracted(self):
+        with tempfile.TemporaryDirectory() as directory:
+            bundle = os.path.join(directory, 'stores.bundle')
+            with bundle_bcd.BundleWriter(bundle) as writer:
+                writer.add('../evil', b'regf')
+            out = os.path.join(directory, 'out')
+            os.mkdir(out)
+            with redirect_stdout(io.StringIO()):
+                self.assertEqual(bundle_bcd.main(['extract', bundle, '-o', out]), 1)
+            self.assertEqual(sorted(os.listdir(directory)), ['out', 'stores.bundle'])
+            self.assertEqual(os.listdir(out), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
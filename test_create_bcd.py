@@ -0,0 +1,150 @@
+import json
+import os
+import tempfile
+import unittest
+import uuid
+from unittest import mock
+
+import create_bcd
+import regf
+from read_bcd import BCDStore
+
+DISK_UUID = uuid.UUID('f470029f-14da-41dc-a2ac-f14b055d4a92')
+EFI_PART_UUID = uuid.UUID('e9cc797b-4481-4f8d-910c-a7295adc39f1')
+WIN_PART_UUID = uuid.UUID('45847f60-f197-48fd-893c-060eb28b4202')
+LOADER_UUID = uuid.UUID('0b7a1fd2-6d5c-4bb6-8a34-1b0f3f5f6c11')
+RESUME_UUID = uuid.UUID('7d1c3e0a-92b4-4f0e-b1a5-6c2d8e9f0a22')
+
+
+def hive_tree(image):
+    """{key path: sorted values} of every key of a hive, key names upper-cased as they compare."""
+    hive = regf.Hive.load(image)
+    tree = {}
+    stack = [((), hive.root())]
+    while stack:
+        key_path, node = stack.pop()
+        tree['\\'.join(key_path)] = sorted((name.upper(), t, data) for name, t, data in hive.node_values(node))
+        for child in hive.node_children(node):
+            stack.append((key_path + (hive.node_name(child).upper(),), child))
+    return tree
+
+
+class TemplateTest(unittest.TestCase):
+    def check_template_matches_hive_build(self, backend):
+        template = create_bcd.BCDTemplate.compile(backend)
+        rendered = template.render(DISK_UUID, EFI_PART_UUID, WIN_PART_UUID, LOADER_UUID, RESUME_UUID)
+        bcd = create_bcd.BCD(None, DISK_UUID, EFI_PART_UUID, WIN_PART_UUID, backend)
+        bcd.loader_uuid, bcd.resume_uuid = LOADER_UUID, RESUME_UUID
+        built = bcd.to_bytes()
+        self.assertEqual(regf.header_checksum(rendered), int.from_bytes(rendered[0x1fc:0x200], 'little'))
+        self.assertEqual(hive_tree(rendered), hive_tree(built))
+
+    def test_template_matches_hive_build_regf(self):
+        self.check_template_matches_hive_build('regf')
+
+    @unittest.skipIf(create_bcd.hivex is None, 'hivex is not installed')
+    def test_template_matches_hive_build_hivex(self):
+        self.check_template_matches_hive_build('hivex')
+
+    def test_missing_slot_is_an_error(self):
+        schema = create_bcd.DEFAULT_SCHEMA.copy()
+        schema.remove_element(create_bcd.GUID_WINDOWS_BOOTMGR, create_bcd.BCDE_LIBRARY_TYPE_APPLICATION_DEVICE)
+        schema.remove_element(create_bcd.GUID_WINDOWS_MEMORY_TESTER, create_bcd.BCDE_LIBRARY_TYPE_APPLICATION_DEVICE)
+        with self.assertRaises(ValueError):
+            create_bcd.BCDTemplate.compile('regf', schema)
+
+    def test_deterministic_template_is_reproducible(self):
+        images = [create_bcd.BCDTemplate.compile('regf', deterministic=True).render(
+            DISK_UUID, EFI_PART_UUID, WIN_PART_UUID, LOADER_UUID, RESUME_UUID) for _ in range(2)]
+        self.assertEqual(images[0], images[1])
+
+    def test_deterministic_template_matches_deterministic_build(self):
+        loader_resume = create_bcd.deterministic_uuids(DISK_UUID, EFI_PART_UUID, WIN_PART_UUID)
+        rendered = create_bcd.BCDTemplate.compile('regf', deterministic=True).render(
+            DISK_UUID, EFI_PART_UUID, WIN_PART_UUID, *loader_resume)
+        built = create_bcd.BCD(None, DISK_UUID, EFI_PART_UUID, WIN_PART_UUID, 'regf', deterministic=True).to_bytes()
+        self.assertEqual(rendered, built)
+
+    def test_template_objects_sorted_for_new_guids(self):
+        template = create_bcd.BCDTemplate.compile('regf')
+        image = template.render(DISK_UUID, EFI_PART_UUID, WIN_PART_UUID, LOADER_UUID, RESUME_UUID)
+        objects = regf.find_subkey(image, regf.root_offset(image), 'Objects')
+        self.assertIsNotNone(regf.find_subkey(image, objects, create_bcd.format_uuid(LOADER_UUID)))
+        self.assertIsNotNone(regf.find_subkey(image, objects, create_bcd.format_uuid(RESUME_UUID)))
+
+
+class LoaderTest(unittest.TestCase):
+    def test_default_without_resume_has_no_resume_object(self):
+        bcd = create_bcd.BCD(None, DISK_UUID, EFI_PART_UUID, WIN_PART_UUID, 'regf')
+        bcd.add_loader()
+        bcd.add_loader(description='No resume', resume=False, default=True)
+        with BCDStore(bcd.to_bytes()) as store:
+            bootmgr = store[create_bcd.GUID_WINDOWS_BOOTMGR]
+            self.assertNotIn(create_bcd.BCDE_BOOTMGR_TYPE_RESUME_OBJECT, bootmgr)
+
+
+class MetricsTest(unittest.TestCase):
+    def test_no_clock_reads_without_metrics(self):
+        template = create_bcd.BCDTemplate.compile('regf')
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch('create_bcd.time.perf_counter', side_effect=AssertionError('clock read')):
+            bcd = create_bcd.BCD(os.path.join(directory, 'direct.bcd'), DISK_UUID, EFI_PART_UUID, WIN_PART_UUID,
+                                 'regf')
+            bcd.create()
+            bcd.write_to(bytearray(len(bcd.to_bytes())))
+            template.create(os.path.join(directory, 'template.bcd'), DISK_UUID, EFI_PART_UUID, WIN_PART_UUID)
+            create_bcd.BCDTemplate.compile('regf')
+
+
+class StoreCacheTest(unittest.TestCase):
+    def test_put_existing_key_counts_once(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = create_bcd.StoreCache(directory)
+            cache.put('ab01', bytes(100))
+            cache.put('ab01', bytes(100))
+            self.assertEqual(cache._size, 100)
+
+    def test_stale_tmp_files_are_removed(self):
+        with tempfile.TemporaryDirectory() as directory:
+            os.makedirs(os.path.join(directory, 'ab'))
+            stale, fresh = os.path.join(directory, 'ab', 'stale.tmp'), os.path.join(directory, 'ab', 'fresh.tmp')
+            for tmp in (stale, fresh):
+                with open(tmp, 'wb') as f:
+                    f.write(bytes(10))
+            old = os.stat(stale).st_mtime - create_bcd.STALE_TMP_SECONDS - 1
+            os.utime(stale, (old, old))
+            cache = create_bcd.StoreCache(directory)
+            self.assertFalse(os.path.exists(stale))
+            self.assertTrue(os.path.exists(fresh))
+            self.assertEqual(cache._size, 10)
+
+    def test_shared_directory_stays_bounded(self):
+        with tempfile.TemporaryDirectory() as directory:
+            caches = [create_bcd.StoreCache(directory, max_bytes=16 * 1000) for _ in range(4)]
+            for i in range(200):
+                caches[i % len(caches)].put(f'{i:064x}', bytes(1000))
+            on_disk = sum(size for _, _, size in caches[0]._entries())
+            self.assertLessEqual(on_disk, 16 * 1000 * (1 + len(caches) / 16))
+
+
+class BatchTest(unittest.TestCase):
+    def test_bad_rows_fail_alone(self):
+        with tempfile.TemporaryDirectory() as directory:
+            good = {'disk_uuid': str(DISK_UUID), 'efi_part_uuid': str(EFI_PART_UUID),
+                    'win_part_uuid': str(WIN_PART_UUID)}
+            manifest = os.path.join(directory, 'manifest.jsonl')
+            with open(manifest, 'w') as f:
+                f.write(json.dumps(dict(good, output_path=os.path.join(directory, '0.bcd'))) + '\n')
+                f.write('{"disk_uuid": broken\n')
+                f.write('"x"\n')
+                f.write(json.dumps({'disk_uuid': str(DISK_UUID)}) + '\n')
+                f.write(json.dumps(dict(good, output_path=os.path.join(directory, '4.bcd'))) + '\n')
+            results = sorted(create_bcd.create_batch(create_bcd.read_manifest(manifest), max_workers=1,
+                                                     backend='regf'))
+            self.assertEqual([r.index for r in results if r.error is None], [0, 4])
+            self.assertEqual([r.index for r in results if isinstance(r.error, ValueError)], [1, 2, 3])
+            self.assertTrue(os.path.exists(os.path.join(directory, '4.bcd')))
+
+
+if __name__ == '__main__':
+    unittest.main()
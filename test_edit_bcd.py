@@ -0,0 +1,108 @@
+import os
+import struct
+import tempfile
+import unittest
+import uuid
+
+import create_bcd
+import regf
+from read_bcd import BCDStore
+
+DISK_UUID = uuid.UUID('f470029f-14da-41dc-a2ac-f14b055d4a92')
+EFI_PART_UUID = uuid.UUID('e9cc797b-4481-4f8d-910c-a7295adc39f1')
+WIN_PART_UUID = uuid.UUID('45847f60-f197-48fd-893c-060eb28b4202')
+NEW_OBJECT = '{8e0c4f3a-5d7b-4c21-9a6e-2f1b3c4d5e6f}'
+
+
+def object_key(image, guid):
+    objects = regf.find_subkey(image, regf.root_offset(image), 'Objects')
+    return regf.find_subkey(image, objects, guid)
+
+
+def key_timestamp(image, offset):
+    return struct.unpack_from('<Q', image, regf.cell_data(offset) + regf.NK_TIMESTAMP)[0]
+
+
+def key_security(image, offset):
+    """(descriptor bytes, reference count) of the sk cell of a key."""
+    sk_pos = regf.cell_data(struct.unpack_from('<I', image, regf.cell_data(offset) + regf.NK_SECURITY)[0])
+    refcount, size = struct.unpack_from('<II', image, sk_pos + 12)
+    return image[sk_pos + 20:sk_pos + 20 + size], refcount
+
+
+class EditTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store_file = os.path.join(self.directory.name, 'BCD')
+        create_bcd.BCD(self.store_file, DISK_UUID, EFI_PART_UUID, WIN_PART_UUID, 'regf', deterministic=True).create()
+        with open(self.store_file, 'rb') as f:
+            self.original = f.read()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def read(self):
+        with open(self.store_file, 'rb') as f:
+            return f.read()
+
+    def test_same_size_change_is_patched_in_place(self):
+        editor = create_bcd.BCD.open(self.store_file)
+        editor.set_timeout(5)
+        self.assertFalse(editor.rewrite_needed)
+        editor.save()
+        image = self.read()
+        self.assertEqual(len(image), len(self.original))
+        changed = [i for i, (a, b) in enumerate(zip(image, self.original)) if a != b]
+        self.assertEqual(len(changed), 1)
+        with BCDStore(image) as store:
+            bootmgr = store[create_bcd.GUID_WINDOWS_BOOTMGR]
+            self.assertEqual(bootmgr.get(create_bcd.BCDE_BOOTMGR_TYPE_TIMEOUT), 5)
+
+    def test_structural_change_rewrites_the_hive(self):
+        editor = create_bcd.BCD.open(self.store_file)
+        editor.add_object(NEW_OBJECT, create_bcd.OBJECT_TYPE_BAD_MEMORY)
+        editor.remove_object(create_bcd.GUID_EMS_SETTINGS_GROUP)
+        editor.set_element(create_bcd.GUID_WINDOWS_BOOTMGR, create_bcd.BCDE_LIBRARY_TYPE_DESCRIPTION,
+                           create_bcd.string_element('A longer Windows Boot Manager description'))
+        self.assertTrue(editor.rewrite_needed)
+        editor.save()
+        image = self.read()
+        with BCDStore(image) as store:
+            self.assertIn(NEW_OBJECT.lower(), store)
+            self.assertNotIn(create_bcd.GUID_EMS_SETTINGS_GROUP, store)
+            self.assertEqual(store[create_bcd.GUID_WINDOWS_BOOTMGR].get(create_bcd.BCDE_LIBRARY_TYPE_DESCRIPTION),
+                             'A longer Windows Boot Manager description')
+            self.assertEqual(store[create_bcd.GUID_WINDOWS_MEMORY_TESTER].type_dword,
+                             create_bcd.OBJECT_TYPE_WINDOWS_MEMORY_TESTER)
+
+    def test_rewrite_keeps_timestamps_and_security(self):
+        # give one object a security descriptor of its own
+        hive = regf.Hive.load(self.original)
+        objects = hive.node_get_child(hive.root(), 'Objects')
+        tester = hive.node_get_child(objects, create_bcd.GUID_WINDOWS_MEMORY_TESTER)
+        own_sk = bytearray(hive._sks[hive._security[tester]])
+        own_sk[20 + struct.unpack_from('<I', own_sk, 16)[0] - 1] ^= 0xff
+        hive._security[tester] = len(hive._sks)
+        hive._sks.append(bytes(own_sk))
+        with open(self.store_file, 'wb') as f:
+            f.write(hive.to_bytes())
+        before = self.read()
+
+        editor = create_bcd.BCD.open(self.store_file)
+        editor.add_object(NEW_OBJECT, create_bcd.OBJECT_TYPE_BAD_MEMORY)
+        editor.save()
+        image = self.read()
+        for guid in (create_bcd.GUID_WINDOWS_BOOTMGR, create_bcd.GUID_WINDOWS_MEMORY_TESTER):
+            self.assertEqual(key_timestamp(image, object_key(image, guid)),
+                             key_timestamp(before, object_key(before, guid)))
+        self.assertEqual(key_security(image, object_key(image, create_bcd.GUID_WINDOWS_MEMORY_TESTER)),
+                         (key_security(before, object_key(before, create_bcd.GUID_WINDOWS_MEMORY_TESTER))[0], 1))
+        self.assertNotEqual(key_security(image, object_key(image, create_bcd.GUID_WINDOWS_BOOTMGR))[0],
+                            key_security(image, object_key(image, create_bcd.GUID_WINDOWS_MEMORY_TESTER))[0])
+        # the new key was written now, not at the time of the original store
+        self.assertGreater(key_timestamp(image, object_key(image, NEW_OBJECT)),
+                           key_timestamp(image, object_key(image, create_bcd.GUID_WINDOWS_BOOTMGR)))
+
+
+if __name__ == '__main__':
+    unittest.main()
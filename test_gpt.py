@@ -0,0 +1,95 @@
+import unittest
+import uuid
+import zlib
+
+import gpt
+
+DISK_UUID = uuid.UUID('f470029f-14da-41dc-a2ac-f14b055d4a92')
+EFI_PART_UUID = uuid.UUID('e9cc797b-4481-4f8d-910c-a7295adc39f1')
+SMALL_PART_UUID = uuid.UUID('6b1c2d3e-4f50-4a61-8b72-93a4b5c6d7e8')
+WIN_PART_UUID = uuid.UUID('45847f60-f197-48fd-893c-060eb28b4202')
+
+ENTRIES = 128
+
+PARTITIONS = [
+    (gpt.GUID_EFI_SYSTEM_PARTITION, EFI_PART_UUID, 40, 79, 'EFI system partition'),
+    (gpt.GUID_MICROSOFT_BASIC_DATA, SMALL_PART_UUID, 80, 99, 'Recovery'),
+    (gpt.GUID_MICROSOFT_BASIC_DATA, WIN_PART_UUID, 100, 199, 'Windows'),
+]
+
+
+def _header(sector_size, current_lba, backup_lba, entries_lba, entries_crc, sectors):
+    fields = [gpt.GPT_SIGNATURE, 0x10000, gpt.GPT_HEADER.size, 0, 0, current_lba, backup_lba, 34,
+              sectors - 34, DISK_UUID.bytes_le, entries_lba, ENTRIES, gpt.GPT_ENTRY.size, entries_crc]
+    fields[3] = zlib.crc32(gpt.GPT_HEADER.pack(*fields))
+    return gpt.GPT_HEADER.pack(*fields)
+
+
+def disk_image(sector_size=512, protective=True, corrupt_primary=False, sectors=256):
+    """A disk image with a protective MBR, a primary and a backup GPT and PARTITIONS."""
+    image = bytearray(sectors * sector_size)
+    image[510:512] = gpt.MBR_SIGNATURE
+    image[446 + 4] = gpt.MBR_TYPE_PROTECTIVE if protective else 0x07
+    entries = bytearray(ENTRIES * gpt.GPT_ENTRY.size)
+    for i, (type_uuid, part_uuid, first_lba, last_lba, name) in enumerate(PARTITIONS):
+        gpt.GPT_ENTRY.pack_into(entries, i * gpt.GPT_ENTRY.size, type_uuid.bytes_le, part_uuid.bytes_le,
+                                first_lba, last_lba, 0, name.encode('utf-16-le'))
+    entries_crc = zlib.crc32(entries)
+    entries_sectors = len(entries) // sector_size
+    backup_entries_lba = sectors - 1 - entries_sectors
+    image[2 * sector_size:2 * sector_size + len(entries)] = entries
+    image[backup_entries_lba * sector_size:(sectors - 1) * sector_size] = entries
+    primary = _header(sector_size, 1, sectors - 1, 2, entries_crc, sectors)
+    image[sector_size:sector_size + len(primary)] = primary
+    backup = _header(sector_size, sectors - 1, 1, backup_entries_lba, entries_crc, sectors)
+    image[(sectors - 1) * sector_size:(sectors - 1) * sector_size + len(backup)] = backup
+    if corrupt_primary:
+        image[sector_size + 0x38] ^= 0xff
+    return image
+
+
+class GptTest(unittest.TestCase):
+    def test_512_byte_sectors(self):
+        disk = gpt.parse_gpt(disk_image(512))
+        self.assertEqual((disk.disk_uuid, disk.sector_size), (DISK_UUID, 512))
+        self.assertEqual([p.part_uuid for p in disk.partitions], [EFI_PART_UUID, SMALL_PART_UUID, WIN_PART_UUID])
+        self.assertEqual(disk.partitions[2].name, 'Windows')
+
+    def test_4096_byte_sectors(self):
+        disk = gpt.parse_gpt(disk_image(4096, sectors=64))
+        self.assertEqual((disk.disk_uuid, disk.sector_size), (DISK_UUID, 4096))
+        self.assertEqual(len(disk.partitions), len(PARTITIONS))
+
+    def test_backup_header_when_primary_crc_is_bad(self):
+        disk = gpt.parse_gpt(disk_image(corrupt_primary=True))
+        self.assertEqual(disk.disk_uuid, DISK_UUID)
+        self.assertEqual(len(disk.partitions), len(PARTITIONS))
+
+    def test_no_protective_mbr(self):
+        with self.assertRaisesRegex(ValueError, 'protective MBR'):
+            gpt.parse_gpt(disk_image(protective=False))
+        image = disk_image()
+        image[510:512] = b'\x00\x00'
+        with self.assertRaisesRegex(ValueError, 'protective MBR'):
+            gpt.parse_gpt(image)
+
+    def test_no_valid_header(self):
+        image = disk_image(corrupt_primary=True)
+        image[-512] ^= 0xff
+        with self.assertRaisesRegex(ValueError, 'no valid GPT header'):
+            gpt.parse_gpt(image)
+
+    def test_largest_basic_data_partition_is_windows(self):
+        disk = gpt.parse_gpt(disk_image())
+        self.assertEqual(gpt.find_windows_partitions(disk), (EFI_PART_UUID, WIN_PART_UUID))
+
+    def test_missing_partitions(self):
+        disk = gpt.parse_gpt(disk_image())
+        with self.assertRaisesRegex(ValueError, 'EFI system partition'):
+            gpt.find_windows_partitions(disk._replace(partitions=disk.partitions[1:]))
+        with self.assertRaisesRegex(ValueError, 'basic data partition'):
+            gpt.find_windows_partitions(disk._replace(partitions=disk.partitions[:1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import os
+import struct
+import tempfile
+import unittest
+
+import create_bcd
+import regf
+
+BIG_VALUE = bytes(range(256)) * 160
+
+
+def build_image():
+    hive = regf.Hive(create_bcd.minimal_image())
+    root = hive.root()
+    for name in ('zeta', 'Alpha', 'mid', 'BETA', 'Grüße'):
+        hive.node_add_child(root, name)
+    big = hive.node_add_child(hive.node_get_child(root, 'mid'), 'big')
+    hive.node_set_values(big, [
+        {'key': 'Big', 't': regf.REG_BINARY, 'value': BIG_VALUE},
+        {'key': 'Small', 't': regf.REG_DWORD, 'value': struct.pack('<I', 7)},
+        {'key': 'Medium', 't': regf.REG_SZ, 'value': 'medium'.encode('utf-16-le') + b'\x00\x00'},
+    ])
+    return hive.to_bytes()
+
+
+def nk_cells(image):
+    """Offsets of every key of the hive, root first."""
+    keys = []
+    stack = [regf.root_offset(image)]
+    while stack:
+        offset = stack.pop()
+        keys.append(offset)
+        stack.extend(regf.subkey_offsets(image, offset))
+    return keys
+
+
+class WriterTest(unittest.TestCase):
+    def setUp(self):
+        self.image = build_image()
+
+    def test_base_block_checksum(self):
+        checksum = 0
+        for dword in struct.unpack_from('<127I', self.image):
+            checksum ^= dword
+        self.assertEqual(struct.unpack_from('<I', self.image, regf.CHECKSUM_OFFSET)[0], checksum)
+        self.assertEqual(self.image[:4], b'regf')
+
+    def test_hbins_tile_the_file(self):
+        bins_size = struct.unpack_from('<I', self.image, 0x28)[0]
+        self.assertEqual(len(self.image), regf.HBIN_START + bins_size)
+        pos = regf.HBIN_START
+        while pos < len(self.image):
+            sig, offset, size = struct.unpack_from('<4sII', self.image, pos)
+            self.assertEqual((sig, offset), (b'hbin', pos - regf.HBIN_START))
+            self.assertEqual(size % regf.HBIN_SIZE, 0)
+            # cells are 8 byte aligned and fill their bin exactly
+            cell = pos + regf.HBIN_HEADER_SIZE
+            while cell < pos + size:
+                cell_size = abs(struct.unpack_from('<i', self.image, cell)[0])
+                self.assertEqual(cell_size % 8, 0)
+                self.assertGreater(cell_size, 0)
+                cell += cell_size
+            self.assertEqual(cell, pos + size)
+            pos += size
+        self.assertEqual(pos, len(self.image))
+
+    def test_big_value_is_split_into_db_segments(self):
+        mid = regf.find_subkey(self.image, regf.root_offset(self.image), 'mid')
+        big = regf.find_subkey(self.image, mid, 'big')
+        vk = regf.find_value(self.image, big, 'Big')
+        self.assertEqual(regf.vk_data_position(self.image, vk), (None, len(BIG_VALUE)))
+        db = regf.cell_data(struct.unpack_from('<I', self.image, regf.cell_data(vk) + regf.VK_DATA)[0])
+        sig, segments = struct.unpack_from('<2sH', self.image, db)
+        self.assertEqual((sig, segments), (b'db', -(-len(BIG_VALUE) // regf.MAX_DATA_SIZE)))
+        self.assertEqual(regf.vk_data(self.image, vk), BIG_VALUE)
+        self.assertEqual(regf.vk_data(self.image, regf.find_value(self.image, big, 'Small')), struct.pack('<I', 7))
+
+    def test_lh_lists_are_sorted_with_hashes(self):
+        for offset in nk_cells(self.image):
+            if not struct.unpack_from('<I', self.image, regf.cell_data(offset) + regf.NK_SUBKEY_COUNT)[0]:
+                continue
+            list_pos = regf.cell_data(struct.unpack_from('<I', self.image,
+                                                         regf.cell_data(offset) + regf.NK_SUBKEY_LIST)[0])
+            sig, count = struct.unpack_from('<2sH', self.image, list_pos)
+            self.assertEqual(sig, b'lh')
+            entries = [struct.unpack_from('<II', self.image, list_pos + 4 + 8 * i) for i in range(count)]
+            names = [regf.nk_name(self.image, child) for child, _ in entries]
+            self.assertEqual(names, sorted(names, key=str.upper))
+            self.assertEqual([h for _, h in entries], [regf.name_hash(name) for name in names])
+        root = regf.root_offset(self.image)
+        self.assertEqual([regf.nk_name(self.image, child) for child in regf.subkey_offsets(self.image, root)],
+                         ['Alpha', 'BETA', 'Grüße', 'mid', 'zeta'])
+
+    def test_sk_refcount_matches_keys(self):
+        keys = nk_cells(self.image)
+        sks = {struct.unpack_from('<I', self.image, regf.cell_data(offset) + regf.NK_SECURITY)[0] for offset in keys}
+        self.assertEqual(len(sks), 1)
+        sk = sks.pop()
+        sig, _, flink, blink, refcount = struct.unpack_from('<2sHIII', self.image, regf.cell_data(sk))
+        self.assertEqual((sig, flink, blink, refcount), (b'sk', sk, sk, len(keys)))
+
+    @unittest.skipIf(create_bcd.hivex is None, 'hivex is not installed')
+    def test_hivex_reads_the_output(self):
+        with tempfile.TemporaryDirectory() as directory:
+            hive_file = os.path.join(directory, 'hive')
+            with open(hive_file, 'wb') as f:
+                f.write(self.image)
+            h = create_bcd.hivex.Hivex(hive_file)
+            big = h.node_get_child(h.node_get_child(h.root(), 'mid'), 'big')
+            values = {h.value_key(v): h.value_value(v) for v in h.node_values(big)}
+            self.assertEqual(values['Big'], (regf.REG_BINARY, BIG_VALUE))
+            self.assertEqual(sorted(h.node_name(c) for c in h.node_children(h.root())),
+                             sorted(['zeta', 'Alpha', 'mid', 'BETA', 'Grüße']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+import json
+import os
+import tempfile
+import unittest
+import uuid
+
+import create_bcd
+import validate_bcd
+
+DISK_UUID = uuid.UUID('f470029f-14da-41dc-a2ac-f14b055d4a92')
+EFI_PART_UUID = uuid.UUID('e9cc797b-4481-4f8d-910c-a7295adc39f1')
+WIN_PART_UUID = uuid.UUID('45847f60-f197-48fd-893c-060eb28b4202')
+
+
+class ManifestTest(unittest.TestCase):
+    def test_bad_rows_become_error_entries(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store_file = os.path.join(directory, 'store.bcd')
+            create_bcd.BCD(store_file, DISK_UUID, EFI_PART_UUID, WIN_PART_UUID, 'regf').create()
+            good = {'disk_uuid': str(DISK_UUID), 'efi_part_uuid': str(EFI_PART_UUID),
+                    'win_part_uuid': str(WIN_PART_UUID), 'output_path': store_file}
+            manifest = os.path.join(directory, 'manifest.jsonl')
+            with open(manifest, 'w') as f:
+                for row in (good, dict(good, disk_uuid=5), dict(good, efi_part_uuid='nope'),
+                            {'output_path': store_file}, 'x'):
+                    f.write(json.dumps(row) + '\n')
+                f.write('{broken\n')
+            report = os.path.join(directory, 'report.jsonl')
+            self.assertEqual(validate_bcd.main(['--manifest', manifest, '--report', report, '--workers', '1']), 1)
+            with open(report) as f:
+                entries = [json.loads(line) for line in f]
+            self.assertEqual([entry['ok'] for entry in entries], [True] + [False] * 5)
+            self.assertTrue(all(entry['error'] for entry in entries[1:]))
+
+
+if __name__ == '__main__':
+    unittest.main()
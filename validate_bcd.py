@@ -0,0 +1,316 @@
+"""Check finished BCD stores for consistency, in bulk.
+
+Per store, the inheritance graph is built once from the BCDE_LIBRARY_TYPE_INHERIT lists and checked
+for missing, mistyped and cyclic groups. Boot manager and loader references must name objects of
+the right type, element values must agree with the format encoded in their BCDE type and device
+elements must point at the expected disk and partitions.
+"""
+import argparse
+import json
+import sys
+import time
+import uuid
+from collections import namedtuple
+
+from create_bcd import (BCDE_BOOTMGR_TYPE_DEFAULT_OBJECT, BCDE_BOOTMGR_TYPE_DISPLAY_ORDER,
+                        BCDE_BOOTMGR_TYPE_RESUME_OBJECT, BCDE_BOOTMGR_TYPE_TOOLS_DISPLAY_ORDER,
+                        BCDE_LIBRARY_TYPE_INHERIT, BCDE_OSLOADER_TYPE_ASSOCIATED_RESUME_OBJECT,
+                        ELEMENT_FORMAT_BOOLEAN, ELEMENT_FORMAT_DEVICE, ELEMENT_FORMAT_GUID, ELEMENT_FORMAT_GUID_LIST,
+                        ELEMENT_FORMAT_INTEGER, ELEMENT_FORMAT_INTEGER_LIST, ELEMENT_FORMAT_STRING,
+                        GUID_BAD_MEMORY_GROUP, GUID_BOOT_LOADER_SETTINGS_GROUP, GUID_DEBUGGER_SETTINGS_GROUP,
+                        GUID_EMS_SETTINGS_GROUP, GUID_FIRMWARE_BOOTMGR, GUID_GLOBAL_SETTINGS_GROUP,
+                        GUID_HYPERVISOR_SETTINGS_GROUP, GUID_RESUME_LOADER_SETTINGS_GROUP, GUID_WINDOWS_BOOTMGR,
+                        GUID_WINDOWS_MEMORY_TESTER, MANIFEST_FIELDS, OBJECT_INHERITABLE_BY_APPLICATION,
+                        OBJECT_INHERITABLE_BY_DEVICE, OBJECT_TYPE_APPLICATION, OBJECT_TYPE_BAD_MEMORY,
+                        OBJECT_TYPE_BOOT_LOADER_SETTINGS, OBJECT_TYPE_DEBUGGER_SETTINGS, OBJECT_TYPE_DEVICE,
+                        OBJECT_TYPE_EMS_SETTINGS, OBJECT_TYPE_FIRMWARE_BOOTMGR, OBJECT_TYPE_GLOBAL_SETTINGS,
+                        OBJECT_TYPE_HYPERVISOR_SETTINGS, OBJECT_TYPE_INHERIT, OBJECT_TYPE_RESUME_LOADER_SETTINGS,
+                        OBJECT_TYPE_WINDOWS_BOOTMGR, OBJECT_TYPE_WINDOWS_LOADER, OBJECT_TYPE_WINDOWS_MEMORY_TESTER,
+                        OBJECT_TYPE_WINDOWS_RESUME, manifest_row_uuids, parse_manifest_row,
+                        read_manifest)
+from read_bcd import BCDStore, element_format, expand_paths, map_files, rate_summary
+from regf import REG_BINARY, REG_MULTI_SZ, REG_SZ
+
+OBJECT_CLASS_MASK = 0xf000_0000
+OBJECT_INHERITABLE_MASK = 0x00f0_0000
+
+# Types of the well-known objects
+WELL_KNOWN_OBJECT_TYPES = {
+    GUID_EMS_SETTINGS_GROUP: OBJECT_TYPE_EMS_SETTINGS,
+    GUID_RESUME_LOADER_SETTINGS_GROUP: OBJECT_TYPE_RESUME_LOADER_SETTINGS,
+    GUID_DEBUGGER_SETTINGS_GROUP: OBJECT_TYPE_DEBUGGER_SETTINGS,
+    GUID_BAD_MEMORY_GROUP: OBJECT_TYPE_BAD_MEMORY,
+    GUID_BOOT_LOADER_SETTINGS_GROUP: OBJECT_TYPE_BOOT_LOADER_SETTINGS,
+    GUID_GLOBAL_SETTINGS_GROUP: OBJECT_TYPE_GLOBAL_SETTINGS,
+    GUID_HYPERVISOR_SETTINGS_GROUP: OBJECT_TYPE_HYPERVISOR_SETTINGS,
+    GUID_WINDOWS_BOOTMGR: OBJECT_TYPE_WINDOWS_BOOTMGR,
+    GUID_FIRMWARE_BOOTMGR: OBJECT_TYPE_FIRMWARE_BOOTMGR,
+    GUID_WINDOWS_MEMORY_TESTER: OBJECT_TYPE_WINDOWS_MEMORY_TESTER,
+}
+
+# Application elements mean different things per application type, so references are looked up
+# by object type first. The allowed types are exact object types or, with no application type
+# bits set, a whole object class.
+REFERENCE_ELEMENTS = {
+    OBJECT_TYPE_WINDOWS_BOOTMGR: {
+        BCDE_BOOTMGR_TYPE_DEFAULT_OBJECT: (OBJECT_TYPE_WINDOWS_LOADER,),
+        BCDE_BOOTMGR_TYPE_RESUME_OBJECT: (OBJECT_TYPE_WINDOWS_RESUME,),
+        BCDE_BOOTMGR_TYPE_DISPLAY_ORDER: (OBJECT_TYPE_APPLICATION,),
+        BCDE_BOOTMGR_TYPE_TOOLS_DISPLAY_ORDER: (OBJECT_TYPE_APPLICATION,),
+    },
+    OBJECT_TYPE_FIRMWARE_BOOTMGR: {
+        BCDE_BOOTMGR_TYPE_DISPLAY_ORDER: (OBJECT_TYPE_APPLICATION,),
+    },
+    OBJECT_TYPE_WINDOWS_LOADER: {
+        BCDE_OSLOADER_TYPE_ASSOCIATED_RESUME_OBJECT: (OBJECT_TYPE_WINDOWS_RESUME,),
+    },
+}
+
+# Registry type and a size check per element format
+FORMAT_VALUE_TYPES = {
+    ELEMENT_FORMAT_DEVICE: (REG_BINARY, lambda size: size >= 0x10),
+    ELEMENT_FORMAT_STRING: (REG_SZ, None),
+    ELEMENT_FORMAT_GUID: (REG_SZ, None),
+    ELEMENT_FORMAT_GUID_LIST: (REG_MULTI_SZ, None),
+    ELEMENT_FORMAT_INTEGER: (REG_BINARY, lambda size: 0 < size <= 8),
+    ELEMENT_FORMAT_BOOLEAN: (REG_BINARY, lambda size: 0 < size <= 4),
+    ELEMENT_FORMAT_INTEGER_LIST: (REG_BINARY, lambda size: size % 8 == 0),
+}
+
+DEVICE_TYPE_QUALIFIED_PARTITION = 0x06
+
+Issue = namedtuple('Issue', 'object element code message')
+
+
+def _type_matches(type_dword, allowed):
+    for expected in allowed:
+        if expected & ~OBJECT_CLASS_MASK:
+            if type_dword == expected:
+                return True
+        elif type_dword & OBJECT_CLASS_MASK == expected:
+            return True
+    return False
+
+
+def _guids(element):
+    """The lower-case GUIDs of a GUID or GUID list element, None for a malformed one."""
+    value = element.value
+    guids = value if isinstance(value, list) else [value]
+    try:
+        for guid in guids:
+            if not (guid.startswith('{') and guid.endswith('}')):
+                return None
+            uuid.UUID(guid[1:-1])
+    except ValueError:
+        return None
+    return [guid.lower() for guid in guids]
+
+
+def _check_values(store, issues):
+    for obj in store:
+        for element_type in obj:
+            element = obj[element_type]
+            fmt = element_format(element_type)
+            value_type, size_ok = FORMAT_VALUE_TYPES.get(fmt, (None, None))
+            if value_type is None:
+                continue
+            if element.value_type != value_type:
+                issues.append(Issue(obj.guid, element_type, 'value-type',
+                                    f'registry type {element.value_type}, format needs {value_type}'))
+            elif size_ok is not None and not size_ok(len(element.data)):
+                issues.append(Issue(obj.guid, element_type, 'value-size', f'{len(element.data)} bytes'))
+            elif fmt in (ELEMENT_FORMAT_GUID, ELEMENT_FORMAT_GUID_LIST) and _guids(element) is None:
+                issues.append(Issue(obj.guid, element_type, 'bad-guid', f'{element.value!r} is not a GUID'))
+
+
+def _check_types(store, issues):
+    for obj in store:
+        if obj.type_dword is None:
+            issues.append(Issue(obj.guid, None, 'missing-type', 'object has no Description\\Type'))
+            continue
+        expected = WELL_KNOWN_OBJECT_TYPES.get(obj.guid)
+        if expected is not None and obj.type_dword != expected:
+            issues.append(Issue(obj.guid, None, 'object-type',
+                                f'type {obj.type_dword:#010x}, expected {expected:#010x}'))
+
+
+def _check_references(store, issues):
+    for obj in store:
+        for element_type, allowed in REFERENCE_ELEMENTS.get(obj.type_dword, {}).items():
+            if element_type not in obj:
+                continue
+            for guid in _guids(obj[element_type]) or ():
+                target = store.objects.get(guid)
+                if target is None:
+                    issues.append(Issue(obj.guid, element_type, 'missing-reference', f'{guid} does not exist'))
+                elif target.type_dword is not None and not _type_matches(target.type_dword, allowed):
+                    issues.append(Issue(obj.guid, element_type, 'reference-type',
+                                        f'{guid} has type {target.type_dword:#010x}'))
+
+
+def inheritance_graph(store):
+    """{object guid: [inherited group guids]} of the objects with an inherit list."""
+    graph = {}
+    for obj in store:
+        if BCDE_LIBRARY_TYPE_INHERIT in obj:
+            graph[obj.guid] = _guids(obj[BCDE_LIBRARY_TYPE_INHERIT]) or []
+    return graph
+
+
+def _check_inheritance(store, issues):
+    graph = inheritance_graph(store)
+    for guid, groups in graph.items():
+        inheritor_class = (store.objects[guid].type_dword or 0) & OBJECT_CLASS_MASK
+        for group in groups:
+            target = store.objects.get(group)
+            if target is None:
+                issues.append(Issue(guid, BCDE_LIBRARY_TYPE_INHERIT, 'missing-inherit', f'{group} does not exist'))
+                continue
+            if target.type_dword is None:
+                continue
+            if target.type_dword & OBJECT_CLASS_MASK != OBJECT_TYPE_INHERIT:
+                issues.append(Issue(guid, BCDE_LIBRARY_TYPE_INHERIT, 'inherit-type',
+                                    f'{group} is not an inheritable group'))
+                continue
+            inheritable_by = target.type_dword & OBJECT_INHERITABLE_MASK
+            if ((inheritable_by == OBJECT_INHERITABLE_BY_APPLICATION
+                 and inheritor_class not in (OBJECT_TYPE_APPLICATION, OBJECT_TYPE_INHERIT))
+                    or (inheritable_by == OBJECT_INHERITABLE_BY_DEVICE
+                        and inheritor_class not in (OBJECT_TYPE_DEVICE, OBJECT_TYPE_INHERIT))):
+                issues.append(Issue(guid, BCDE_LIBRARY_TYPE_INHERIT, 'inherit-type',
+                                    f'{group} cannot be inherited by a {inheritor_class:#010x} object'))
+
+    # iterative depth first search, each back edge closes a cycle
+    state = {}
+    for start in graph:
+        if start in state:
+            continue
+        state[start] = 1
+        path = [start]
+        stack = [iter(graph[start])]
+        while stack:
+            group = next(stack[-1], None)
+            if group is None:
+                state[path.pop()] = 2
+                stack.pop()
+            elif state.get(group) == 1:
+                cycle = path[path.index(group):] + [group]
+                issues.append(Issue(path[-1], BCDE_LIBRARY_TYPE_INHERIT, 'inherit-cycle', ' -> '.join(cycle)))
+            elif group not in state and group in graph:
+                state[group] = 1
+                path.append(group)
+                stack.append(iter(graph[group]))
+
+
+def _check_devices(store, issues, disk_uuid, partitions):
+    disks = {}
+    for obj in store:
+        for element_type in obj:
+            if element_format(element_type) != ELEMENT_FORMAT_DEVICE:
+                continue
+            if obj[element_type].value_type != REG_BINARY:
+                continue
+            device = obj[element_type].value
+            if device.device_type != DEVICE_TYPE_QUALIFIED_PARTITION or device.part_uuid is None:
+                continue
+            if device.part_uuid.int == 0 or device.disk_uuid.int == 0:
+                issues.append(Issue(obj.guid, element_type, 'device-partition', 'null partition or disk GUID'))
+            elif partitions is not None and device.part_uuid not in partitions:
+                issues.append(Issue(obj.guid, element_type, 'device-partition',
+                                    f'partition {device.part_uuid} is not on the disk'))
+            if disk_uuid is not None and device.disk_uuid != disk_uuid:
+                issues.append(Issue(obj.guid, element_type, 'device-disk', f'disk {device.disk_uuid}, '
+                                                                          f'expected {disk_uuid}'))
+            disks.setdefault(device.disk_uuid, (obj.guid, element_type))
+    if disk_uuid is None and len(disks) > 1:
+        issues.append(Issue(None, None, 'device-disk', 'devices on several disks: ' + ', '.join(map(str, disks))))
+
+
+def validate(store, disk_uuid=None, partitions=None):
+    """List the Issues of a BCDStore.
+
+    With disk_uuid and partitions (a collection of partition UUIDs) set, every qualified partition
+    device must be on that disk and one of those partitions, otherwise they only need to agree on
+    one disk.
+    """
+    issues = []
+    _check_types(store, issues)
+    _check_values(store, issues)
+    _check_references(store, issues)
+    _check_inheritance(store, issues)
+    _check_devices(store, issues, disk_uuid, partitions)
+    return issues
+
+
+def _validate_file(store_file, row=None):
+    disk_uuid = partitions = None
+    if row is not None:
+        store_file, disk_uuid, efi_part_uuid, win_part_uuid = manifest_row_uuids(parse_manifest_row(row))
+        partitions = frozenset((efi_part_uuid, win_part_uuid))
+    with BCDStore.open(store_file) as store:
+        return validate(store, disk_uuid, partitions)
+
+
+def validate_stores(jobs, max_workers=None, chunksize=64):
+    """Yield a read_bcd.ScanResult with the Issues per job, in order, using a process pool.
+
+    A job is (store_file, None), or (label, row) with a manifest row giving the store file and
+    the disk its devices are checked against. Stores and rows that cannot be read yield a result
+    with the error set.
+    """
+    yield from map_files(_validate_file, jobs, max_workers, chunksize)
+
+
+def report_entry(result):
+    """JSON serializable report of a validate_stores() result."""
+    return {
+        'path': result.path,
+        'ok': result.error is None and not result.result,
+        'error': str(result.error) if result.error is not None else None,
+        'issues': [issue._asdict() for issue in result.result or ()],
+    }
+
+
+def _manifest_jobs(manifest_file):
+    for index, row in enumerate(read_manifest(manifest_file)):
+        try:
+            store_file = parse_manifest_row(row).get('output_path')
+        except ValueError:
+            store_file = None
+        # rows are checked in the workers, so that a bad one only fails its own report entry
+        yield store_file or f'{manifest_file} row {index}', row
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Validate BCD stores and write a JSON Lines report.')
+    parser.add_argument('paths', nargs='*', help='BCD store files or directories of them')
+    parser.add_argument('--manifest', help='CSV or JSONL manifest with ' + ', '.join(MANIFEST_FIELDS)
+                                           + ', to check devices against the disk of every store')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes')
+    parser.add_argument('--report', help='report file (default: stdout)')
+    args = parser.parse_args(argv)
+    if not args.paths and not args.manifest:
+        parser.error('no stores given')
+
+    jobs = [(store_file, None) for store_file in expand_paths(args.paths)]
+    if args.manifest:
+        jobs.extend(_manifest_jobs(args.manifest))
+
+    start = time.perf_counter()
+    failed = 0
+    out = open(args.report, 'w') if args.report else sys.stdout
+    try:
+        for result in validate_stores(jobs, max_workers=args.workers):
+            entry = report_entry(result)
+            failed += not entry['ok']
+            out.write(json.dumps(entry) + '\n')
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    elapsed = time.perf_counter() - start
+    print(rate_summary(len(jobs), elapsed, failed), file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())